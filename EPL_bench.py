@@ -0,0 +1,368 @@
+__author__ = 'Jeremy'
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from collections import defaultdict
+from time import perf_counter, time
+
+import EPL_elite
+import EPL_stub_server
+
+
+class LegacyPlayer(object):
+    def __init__(self):
+        self.name = ""
+        self.playerID = 0
+        self.position = 0
+        self.started = False
+
+
+class LegacyGameWeekTeam(object):
+    """The dict backed team model the crawler used before squads were interned, kept for comparison."""
+    def __init__(self):
+        self.overall_points = 0
+        self.overall_rank = 0
+        self.game_week_points = 0
+        self.players = []
+        self.captain = None
+        self.vice_captain = None
+
+    def create_players(self, player_ids, player_names, player_positions):
+        for i in range(len(player_ids)):
+            p = LegacyPlayer()
+            p.playerID = player_ids[i]
+            p.name = player_names[i]
+            p.position = player_positions[i]
+            if i < 11:
+                p.started = True
+            self.players.append(p)
+
+    def set_captain(self, captain_index):
+        self.captain = self.players[captain_index]
+
+    def set_vice_captain(self, vice_captain_index):
+        self.vice_captain = self.players[vice_captain_index]
+
+
+def synthetic_squads(managers=10000, roster_size=600, seed=1415):
+    """Squads of 15 drawn from a roster_size player pool. Names are rebuilt for every squad, as they are when
+    scraped from separate entry pages."""
+    generator = random.Random(seed)
+    for _ in range(managers):
+        player_ids = generator.sample(range(1, roster_size + 1), 15)
+        names = ["".join(["Player ", str(player_id)]) for player_id in player_ids]
+        captain, vice_captain = generator.sample(range(11), 2)
+        yield player_ids, names, list(range(1, 16)), captain, vice_captain
+
+
+def build_teams(team_factory, managers, roster_size):
+    teams = []
+    for player_ids, names, positions, captain, vice_captain in synthetic_squads(managers, roster_size):
+        team = team_factory()
+        team.create_players(player_ids, names, positions)
+        team.set_captain(captain)
+        team.set_vice_captain(vice_captain)
+        teams.append(team)
+    return teams
+
+
+def measure(build):
+    tracemalloc.start()
+    started = perf_counter()
+    result = build()
+    seconds = perf_counter() - started
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return {"bytes": current, "peak_bytes": peak, "seconds": seconds}
+
+
+def bench_memory(managers=10000, roster_size=600):
+    """Memory held by one synthetic gameweek of teams in the legacy and the slotted, interned model."""
+    legacy = measure(lambda: build_teams(LegacyGameWeekTeam, managers, roster_size))
+    registry = EPL_elite.PlayerRegistry()
+    compact = measure(lambda: (registry, build_teams(lambda: EPL_elite.GameWeekTeam(registry), managers,
+                                                     roster_size)))
+    return {"managers": managers, "legacy": legacy, "compact": compact,
+            "ratio": round(legacy["bytes"] / float(compact["bytes"]), 2)}
+
+
+SQL_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql files")
+
+# the per gameweek queries from sql files/data filters.sql, in sqlite syntax
+ELITE_UTILIZATION_SQL = (
+    "select (count(Position.id) * 100.0 / (select count(*) from GameWeekTeam where game_week = ?)) as elite_util, "
+    "count(Position.id) as count, web_name, selected_by_percent, now_cost, total_points, GameWeekTeam.game_week, "
+    "minutes * 1.0 / total_points as min_per_point, points_per_game, transfers_in - transfers_out as net_xfer "
+    "from Position, Player, GameWeekTeam, GameWeekTeam squad "
+    "where Player.id = Position.id and GameWeekTeam.game_week = ? "
+    "and squad.managerID = GameWeekTeam.managerID and squad.season = GameWeekTeam.season "
+    "and squad.game_week = coalesce(GameWeekTeam.squad_game_week, GameWeekTeam.game_week) "
+    "and squad.gameWeekTeamID = Position.gameWeekTeamID "
+    "group by Position.id order by elite_util desc, now_cost desc")
+MOST_CAPTAINED_SQL = ("select count(captainID) as captained, web_name from GameWeekTeam, Player "
+                      "where Player.id = captainID and GameWeekTeam.game_week = ? "
+                      "group by captainID order by captained desc")
+MOST_VICE_CAPTAINED_SQL = ("select count(vice_captainID) as vice_captained, web_name from GameWeekTeam, Player "
+                           "where Player.id = vice_captainID and GameWeekTeam.game_week = ? "
+                           "group by vice_captainID order by vice_captained desc")
+
+
+def build_synthetic_database(filename, managers=10000, game_weeks=5, roster_size=600, seed=1415):
+    """A sqlite database in the crawler's schema holding game_weeks gameweeks of synthetic elite squads."""
+    generator = random.Random(seed)
+    connection = sqlite3.connect(filename)
+    with open(os.path.join(SQL_DIRECTORY, "sqlite_db_build.sql"), 'r', encoding='UTF-8') as file:
+        connection.executescript(file.read())
+    connection.executemany(
+        "insert into Player (id, web_name, selected_by_percent, now_cost, total_points, minutes, points_per_game, "
+        "transfers_in, transfers_out, element_type, event_total) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(player_id, "Player {0}".format(player_id), round(generator.uniform(0, 60), 1),
+          generator.randint(40, 130), generator.randint(1, 200), generator.randint(0, 3000),
+          round(generator.uniform(0, 8), 1), generator.randint(0, 10 ** 6), generator.randint(0, 10 ** 6),
+          generator.randint(1, 4), generator.randint(0, 15)) for player_id in range(1, roster_size + 1)])
+    for game_week in range(1, game_weeks + 1):
+        teams, positions = [], []
+        squads = synthetic_squads(managers, roster_size, seed + game_week)
+        for manager_id, (player_ids, _, _, captain, vice_captain) in enumerate(squads, 1):
+            team_id = "{0}-{1}".format(manager_id, game_week)
+            teams.append((team_id, game_week, 1415, 0, manager_id, 0, player_ids[captain],
+                          player_ids[vice_captain], manager_id))
+            positions.extend((player_id, team_id, int(i < 11)) for i, player_id in enumerate(player_ids))
+        connection.executemany("insert into GameWeekTeam (gameWeekTeamID, game_week, season, overall_points, "
+                               "overall_rank, game_week_points, captainID, vice_captainID, managerID) "
+                               "values (?, ?, ?, ?, ?, ?, ?, ?, ?)", teams)
+        connection.executemany("insert into Position (id, gameWeekTeamID, started) values (?, ?, ?)", positions)
+    connection.commit()
+    return connection
+
+
+def bench_analytics(managers=10000, game_weeks=5, roster_size=600):
+    """Runs the data filters reports for every gameweek through sqlite and through EliteAnalytics."""
+    directory = tempfile.mkdtemp()
+    connection = build_synthetic_database(os.path.join(directory, "elite.db"), managers, game_weeks, roster_size)
+
+    started = perf_counter()
+    sql_reports = {}
+    for game_week in range(1, game_weeks + 1):
+        sql_reports[game_week] = [connection.execute(query, parameters).fetchall() for query, parameters in
+                                  [(ELITE_UTILIZATION_SQL, (game_week, game_week)),
+                                   (MOST_CAPTAINED_SQL, (game_week,)), (MOST_VICE_CAPTAINED_SQL, (game_week,))]]
+    sql_seconds = perf_counter() - started
+
+    started = perf_counter()
+    analytics = EPL_elite.EliteAnalytics.from_connection(connection)
+    load_seconds = perf_counter() - started
+    vectorized_reports = {}
+    for game_week in range(1, game_weeks + 1):
+        vectorized_reports[game_week] = [analytics.elite_utilization(game_week), analytics.most_captained(game_week),
+                                         analytics.most_vice_captained(game_week)]
+    analytics.utilization_deltas()
+    vectorized_seconds = perf_counter() - started
+    connection.close()
+
+    matches = all([row[1] for row in sql[0]] == [row["count"] for row in vectorized[0]] and
+                  [row[0] for row in sql[1]] == [row["captained"] for row in vectorized[1]]
+                  for sql, vectorized in zip(sql_reports.values(), vectorized_reports.values()))
+    return {"managers": managers, "game_weeks": game_weeks, "sql_seconds": round(sql_seconds, 3),
+            "vectorized_seconds": round(vectorized_seconds, 3), "vectorized_load_seconds": round(load_seconds, 3),
+            "vectorized_query_seconds": round(vectorized_seconds - load_seconds, 3),
+            "speedup": round(sql_seconds / vectorized_seconds, 2), "results_match": matches}
+
+
+def start_stub_server(managers, players, latency, error_rate):
+    """Runs an EPL_stub_server for a synthetic league in its own process, so it doesn't share the crawler's GIL."""
+    ready = multiprocessing.Queue()
+    process = multiprocessing.Process(target=EPL_stub_server.serve, daemon=True,
+                                      kwargs=dict(port=0, managers=managers, players=players, latency=latency,
+                                                  error_rate=error_rate, ready=ready))
+    process.start()
+    return process, ready.get(timeout=30)
+
+
+def create_crawl_controller(url, storage, filename, metrics, concurrency, parse_processes):
+    if storage == "memory":
+        connection_string = "sqlite::memory:"
+    else:
+        connection_string = "sqlite:" + filename
+    controller = EPL_elite.FantasyEPLController(connection_string, base_url=url, concurrency=concurrency,
+                                                parse_processes=parse_processes, game_week=21, metrics=metrics,
+                                                retry_policy=EPL_elite.RetryPolicy(base_delay=0.01, max_delay=0.1))
+    with open(os.path.join(SQL_DIRECTORY, "sqlite_db_build.sql"), 'r', encoding='UTF-8') as file:
+        schema = file.read()
+    for handler in controller.storage_handlers:
+        handler.connection.executescript(schema)
+        handler.statement_log = EPL_elite.StatementLog(filename + ".log.sql")
+    return controller
+
+
+def time_fetches(controller):
+    """Wraps the controller's fetches to keep the wall time of every one, by url class."""
+    fetch_seconds = defaultdict(list)
+    fetch, url_class = controller._fetch, controller.fetcher.retry_policy.url_class
+
+    def timed_fetch(url):
+        started = perf_counter()
+        try:
+            return fetch(url)
+        finally:
+            fetch_seconds[url_class(url)].append(perf_counter() - started)
+    controller._fetch = timed_fetch
+    return fetch_seconds
+
+
+def percentile(values, fraction):
+    """The nearest rank percentile of values, or None if there are none."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where there is no resource module, as on Windows."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux and the BSDs
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def crawl_result(metrics, seconds, items, latencies):
+    db_rows = metrics.counter("db_rows")
+    p50, p99 = percentile(latencies, 0.5), percentile(latencies, 0.99)
+    return {"seconds": round(seconds, 3), "per_second": round(items / seconds, 1),
+            "p50_latency": p50 and round(p50, 4), "p99_latency": p99 and round(p99, 4),
+            "db_rows": db_rows, "db_rows_per_second": round(db_rows / seconds, 1),
+            "retries": metrics.counter("retries")}
+
+
+def bench_crawl(managers=1000, players=600, latency=0.0, error_rate=0.0, concurrency=8, parse_processes=0,
+                storage="file", bulk=True):
+    """Times download_player_stats and download_manager_stats against a synthetic league served locally.
+
+    Latencies are exact percentiles of every element or entry fetch, retries and rate limiting included.
+    """
+    directory = tempfile.mkdtemp()
+    process, url = start_stub_server(managers, players, latency, error_rate)
+    try:
+        metrics = EPL_elite.Metrics()
+        controller = create_crawl_controller(url, storage, os.path.join(directory, "players.db"), metrics,
+                                             concurrency, parse_processes)
+        fetch_seconds = time_fetches(controller)
+        started = perf_counter()
+        controller.download_player_stats(bulk=bulk)
+        player_stats = crawl_result(metrics, perf_counter() - started, players, fetch_seconds["elements"])
+
+        metrics = EPL_elite.Metrics()
+        controller = create_crawl_controller(url, storage, os.path.join(directory, "managers.db"), metrics,
+                                             concurrency, parse_processes)
+        fetch_seconds = time_fetches(controller)
+        started = perf_counter()
+        controller.download_manager_stats(1, managers)
+        manager_stats = crawl_result(metrics, perf_counter() - started, controller.managers_created,
+                                     fetch_seconds["entry"])
+        manager_stats["managers"] = controller.managers_created
+    finally:
+        process.terminate()
+    return {"managers": managers, "players": players, "latency": latency, "error_rate": error_rate,
+            "concurrency": concurrency, "parse_processes": parse_processes, "storage": storage,
+            "download_player_stats": player_stats, "download_manager_stats": manager_stats,
+            "peak_rss_bytes": peak_rss_bytes()}
+
+
+# modules a command that doesn't crawl should never import
+HEAVY_MODULES = ("requests", "bs4", "lxml", "pypyodbc", "pyarrow", "numpy", "orjson", "http.server",
+                 "multiprocessing")
+
+
+def bench_startup(runs=10, max_seconds=None):
+    """Times importing EPL_elite and running its --help in fresh interpreters, and lists any heavy module the import
+    pulls in. With max_seconds the benchmark fails if either median is slower or a heavy module is imported."""
+    directory = os.path.dirname(os.path.abspath(__file__))
+    check = ("import sys, EPL_elite; print(','.join(module for module in {0!r} if module in sys.modules))"
+             .format(HEAVY_MODULES))
+    commands = {"import": [sys.executable, "-c", check], "help": [sys.executable, "-m", "EPL_elite", "--help"]}
+    timings = dict((name, []) for name in commands)
+    imported = ""
+    for _ in range(runs):
+        for name, command in commands.items():
+            started = perf_counter()
+            output = subprocess.run(command, cwd=directory, stdout=subprocess.PIPE, check=True,
+                                    universal_newlines=True).stdout
+            timings[name].append(perf_counter() - started)
+            if name == "import":
+                imported = output.strip()
+    result = {"runs": runs, "import_seconds": round(statistics.median(timings["import"]), 4),
+              "help_seconds": round(statistics.median(timings["help"]), 4),
+              "heavy_modules_imported": imported.split(",") if imported else []}
+    if max_seconds is not None:
+        result["max_seconds"] = max_seconds
+        result["passed"] = (result["import_seconds"] <= max_seconds and result["help_seconds"] <= max_seconds
+                            and not imported)
+    return result
+
+
+def main(arguments=None):
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--output", help="also write the result to this json file")
+    parser = argparse.ArgumentParser(description="Offline benchmarks for the EPL elite crawler.")
+    subparsers = parser.add_subparsers(dest="benchmark")
+    subparsers.required = True
+    memory = subparsers.add_parser("memory", parents=[common], help="memory used by a synthetic gameweek of teams")
+    memory.add_argument("--managers", type=int, default=10000)
+    memory.add_argument("--roster-size", type=int, default=600)
+    analytics = subparsers.add_parser("analytics", parents=[common],
+                                      help="data filters reports in sqlite against EliteAnalytics")
+    analytics.add_argument("--managers", type=int, default=10000)
+    analytics.add_argument("--game-weeks", type=int, default=5)
+    analytics.add_argument("--roster-size", type=int, default=600)
+    crawl = subparsers.add_parser("crawl", parents=[common], help="crawl throughput against a local synthetic league")
+    crawl.add_argument("--managers", type=int, default=1000)
+    crawl.add_argument("--players", type=int, default=600)
+    crawl.add_argument("--latency", type=float, default=0.0, help="seconds the stub server adds to every request")
+    crawl.add_argument("--error-rate", type=float, default=0.0, help="share of requests the stub server drops")
+    crawl.add_argument("--concurrency", type=int, default=8)
+    crawl.add_argument("--parse-processes", type=int, default=0)
+    crawl.add_argument("--storage", choices=["file", "memory"], default="file")
+    crawl.add_argument("--sequential-players", action="store_true",
+                       help="fetch player stats one at a time instead of in bulk")
+    startup = subparsers.add_parser("startup", parents=[common],
+                                    help="EPL_elite import and --help time in a fresh interpreter")
+    startup.add_argument("--runs", type=int, default=10)
+    startup.add_argument("--max-seconds", type=float, help="exit non zero when startup is slower than this")
+    options = parser.parse_args(arguments)
+
+    if options.benchmark == "memory":
+        result = bench_memory(options.managers, options.roster_size)
+    elif options.benchmark == "analytics":
+        result = bench_analytics(options.managers, options.game_weeks, options.roster_size)
+    elif options.benchmark == "crawl":
+        result = bench_crawl(options.managers, options.players, options.latency, options.error_rate,
+                             options.concurrency, options.parse_processes, options.storage,
+                             not options.sequential_players)
+    elif options.benchmark == "startup":
+        result = bench_startup(options.runs, options.max_seconds)
+    result = dict(result, benchmark=options.benchmark, time=time())
+    print(json.dumps(result, indent=2))
+    if options.output:
+        with open(options.output, 'w', encoding='UTF-8') as file:
+            json.dump(result, file, indent=2)
+    if result.get("passed") is False:
+        raise SystemExit(1)
+    return result
+
+
+if __name__ == '__main__':
+    main()
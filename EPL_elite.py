@@ -1,12 +1,64 @@
 __author__ = 'Jeremy'
 import re
+import os
 import json
+import random
+import hashlib
+import importlib
+import importlib.util
+import sqlite3
+import threading
+import uuid
+import zlib
+from array import array
+from bisect import bisect_left
+from collections import Counter, OrderedDict, defaultdict, deque, namedtuple
+import concurrent.futures
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
 from decimal import Decimal
-from time import sleep
-import requests
-import pypyodbc as pyodbc
-from requests.exceptions import HTTPError, RequestException
-from bs4 import BeautifulSoup
+from html import unescape
+from itertools import islice
+from queue import Empty, Full, Queue
+from time import sleep, monotonic, perf_counter, time
+from urllib.parse import urlsplit
+
+
+class _LazyModule(object):
+    """Stands in for a module, and imports it and its submodules the first time one of their attributes is used, so
+    commands that never fetch, parse or connect don't pay for importing what does."""
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        try:
+            return getattr(self._module, attribute)
+        except AttributeError:
+            return importlib.import_module("{0}.{1}".format(self._name, attribute))
+
+
+def _optional_module(name):
+    return _LazyModule(name) if importlib.util.find_spec(name) else None
+
+
+requests = _LazyModule("requests")
+pyodbc = _LazyModule("pypyodbc")
+bs4 = _LazyModule("bs4")
+lxml = _LazyModule("lxml")
+http = _LazyModule("http")
+
+orjson = _optional_module("orjson")
+pyarrow = _optional_module("pyarrow")
+numpy = _optional_module("numpy")
+fcntl = _optional_module("fcntl")
+msvcrt = _optional_module("msvcrt")
+
+
+def json_loads(data):
+    return orjson.loads(data) if orjson else json.loads(data)
 
 
 class IRequest(object):
@@ -14,43 +66,511 @@ class IRequest(object):
         raise NotImplementedError
 
 
+class CircuitBreaker(object):
+    def __init__(self, failure_threshold=5, reset_timeout=300):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.trips = 0
+        self.opened_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None
+
+    def wait_until_closed(self):
+        """Blocks the calling worker while the breaker is open, then lets it through to probe the host."""
+        while True:
+            with self._lock:
+                if self.opened_at is None:
+                    return
+                remaining = self.opened_at + self.reset_timeout - monotonic()
+                if remaining <= 0:
+                    # half open: the next failure trips the breaker again straight away
+                    self.opened_at = None
+                    self.failures = self.failure_threshold - 1
+                    return
+            sleep(remaining)
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold and self.opened_at is None:
+                self.opened_at = monotonic()
+                self.trips += 1
+
+
+class RetryPolicy(object):
+    """Exponential backoff with jitter, retry budgets and one circuit breaker per class of url.
+
+    Backoff only ever sleeps the worker that owns the failing url, so the rest of a concurrent crawl keeps going.
+    A budget of None means unlimited.
+    """
+    URL_CLASSES = [("standings", re.compile(r'/standings/')),
+                   ("entry", re.compile(r'/entry/')),
+                   ("elements", re.compile(r'/web/api/elements/'))]
+
+    def __init__(self, retries_per_request=None, retries_per_run=None, base_delay=5, max_delay=300, jitter=0.5,
+                 failure_threshold=5, reset_timeout=300):
+        self.retries_per_request = retries_per_request
+        self.retries_per_run = retries_per_run
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.retries = Counter()
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def url_class(self, url):
+        for name, pattern in self.URL_CLASSES:
+            if pattern.search(url):
+                return name
+        return "other"
+
+    def breaker(self, url_class):
+        with self._lock:
+            if url_class not in self._breakers:
+                self._breakers[url_class] = CircuitBreaker(self.failure_threshold, self.reset_timeout)
+            return self._breakers[url_class]
+
+    def allow_retry(self, url_class, attempt, retry_limit=None):
+        limit = retry_limit if retry_limit is not None else self.retries_per_request
+        if limit is not None and attempt >= limit:
+            return False
+        with self._lock:
+            if self.retries_per_run is not None and sum(self.retries.values()) >= self.retries_per_run:
+                return False
+            self.retries[url_class] += 1
+        return True
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay - delay * self.jitter * random.random()
+
+    def stats(self):
+        with self._lock:
+            breakers = dict(self._breakers)
+        return {"retries": sum(self.retries.values()),
+                "retries_by_class": dict(self.retries),
+                "breaker_trips": sum(breaker.trips for breaker in breakers.values()),
+                "breaker_trips_by_class": {name: breaker.trips for name, breaker in breakers.items()},
+                "open_breakers": [name for name, breaker in breakers.items() if breaker.is_open]}
+
+
+class Histogram(object):
+    """Cumulative bucket counts, a sum and a count, as a Prometheus histogram keeps them."""
+    LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimates the q quantile by interpolating inside the bucket it falls in."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, bucket_count in enumerate(self.counts):
+            if seen + bucket_count >= rank and bucket_count:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+        return self.buckets[-1]
+
+
+class Metrics(object):
+    """Thread safe counters and histograms for a crawl, optionally labelled, e.g.
+
+    metrics.increment("retries", url_class="entry")
+    with metrics.timer("db_commit_seconds"):
+        ...
+
+    snapshot() gives them as a dict, prometheus_text() in the Prometheus text exposition format.
+    """
+    def __init__(self):
+        self.counters = Counter()
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    def increment(self, name, amount=1, **labels):
+        with self._lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, perf_counter() - started, **labels)
+
+    def counter(self, name, **labels):
+        with self._lock:
+            if labels:
+                return self.counters[(name, tuple(sorted(labels.items())))]
+            return sum(value for (counter_name, _), value in self.counters.items() if counter_name == name)
+
+    def histogram(self, name, **labels):
+        with self._lock:
+            return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def snapshot(self):
+        with self._lock:
+            counters = [{"name": name, "labels": dict(labels), "value": value}
+                        for (name, labels), value in sorted(self.counters.items())]
+            histograms = [{"name": name, "labels": dict(labels), "count": histogram.count,
+                           "sum": round(histogram.sum, 6), "p50": histogram.quantile(0.5),
+                           "p90": histogram.quantile(0.9), "p99": histogram.quantile(0.99)}
+                          for (name, labels), histogram in sorted(self.histograms.items())]
+        return {"time": time(), "counters": counters, "histograms": histograms}
+
+    def prometheus_text(self, prefix="epl_"):
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                if not lines or not lines[-1].startswith(prefix + name + "_total"):
+                    lines.append("# TYPE {0}{1}_total counter".format(prefix, name))
+                lines.append("{0}{1}_total{2} {3}".format(prefix, name, _prometheus_labels(labels), value))
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                if not lines or not lines[-1].startswith(prefix + name + "_count"):
+                    lines.append("# TYPE {0}{1} histogram".format(prefix, name))
+                cumulative = 0
+                for bucket, bucket_count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                    cumulative += bucket_count
+                    lines.append("{0}{1}_bucket{2} {3}".format(prefix, name,
+                                                               _prometheus_labels(labels + (("le", bucket),)),
+                                                               cumulative))
+                lines.append("{0}{1}_sum{2} {3}".format(prefix, name, _prometheus_labels(labels), histogram.sum))
+                lines.append("{0}{1}_count{2} {3}".format(prefix, name, _prometheus_labels(labels),
+                                                          histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def dump(self, filename):
+        temporary_filename = filename + ".tmp"
+        with open(temporary_filename, 'w', encoding='UTF-8') as file:
+            json.dump(self.snapshot(), file, indent=2)
+        os.replace(temporary_filename, filename)
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{0}="{1}"'.format(name, value) for name, value in labels) + "}"
+
+
+METRICS = Metrics()
+
+
+def _metrics_request_handler():
+    # built on first use so that importing this module doesn't import http.server
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            metrics = self.server.metrics
+            if self.path.startswith("/metrics.json"):
+                body, content_type = json.dumps(metrics.snapshot()), "application/json"
+            elif self.path.startswith("/metrics"):
+                body, content_type = metrics.prometheus_text(), "text/plain; version=0.0.4"
+            else:
+                self.send_error(404)
+                return
+            body = body.encode('UTF-8')
+            self.send_response(200)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+    return MetricsRequestHandler
+
+
+class MetricsServer(object):
+    """Serves metrics on localhost, as Prometheus text on /metrics and as json on /metrics.json.
+
+    with MetricsServer(METRICS, 9100):
+        FantasyEPLController(connection_string).download_manager_stats(1, 10000)
+    """
+    def __init__(self, metrics=None, port=0):
+        self.httpd = http.server.ThreadingHTTPServer(('127.0.0.1', port), _metrics_request_handler())
+        self.httpd.daemon_threads = True
+        self.httpd.metrics = metrics if metrics is not None else METRICS
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}/metrics".format(self.httpd.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+class MetricsDumper(object):
+    """Writes a json snapshot of metrics to filename every interval seconds, and once more when stopped."""
+    def __init__(self, filename, metrics=None, interval=10):
+        self.filename = filename
+        self.metrics = metrics if metrics is not None else METRICS
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+        self.metrics.dump(self.filename)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.metrics.dump(self.filename)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def create_session(pool_size=10):
+    """A keep-alive session whose connection pool is large enough for pool_size concurrent workers."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class ResponseCache(object):
+    """On-disk cache of response bodies keyed by url.
+
+    Bodies are zlib compressed and stored once per sha1 of their content, so identical pages share a file. Each url
+    has a small json index record holding the body digest and the ETag / Last-Modified validators. Entries younger
+    than ttl seconds are served without a request, older ones are revalidated; with no ttl every entry is
+    revalidated, and a crawl that should not touch the network at all replays the cache instead. The bytes the
+    bodies take up are counted as they are stored; once they pass max_bytes the index is scanned and the least
+    recently fetched urls are dropped until the bodies fit in EVICTION_TARGET of max_bytes.
+    """
+    EVICTION_TARGET = 0.9
+
+    def __init__(self, directory, ttl=None, max_bytes=1024 ** 3):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._index_directory = os.path.join(directory, "index")
+        self._object_directory = os.path.join(directory, "objects")
+        os.makedirs(self._index_directory, exist_ok=True)
+        os.makedirs(self._object_directory, exist_ok=True)
+        # counted on the first store, then kept up to date by store and evict
+        self._total_bytes = None
+        self._lock = threading.Lock()
+
+    def lookup(self, url):
+        try:
+            with open(self._index_path(url), 'r', encoding='UTF-8') as file:
+                return json.load(file)
+        except (IOError, ValueError):
+            return None
+
+    def is_fresh(self, entry):
+        return self.ttl is not None and time() - entry["fetched_at"] < self.ttl
+
+    def validators(self, entry):
+        headers = {}
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        return headers
+
+    def read(self, entry):
+        with open(self.object_path(entry["digest"]), 'rb') as file:
+            return zlib.decompress(file.read()).decode('UTF-8')
+
+    def store(self, url, text, etag=None, last_modified=None):
+        body = text.encode('UTF-8')
+        digest = hashlib.sha1(body).hexdigest()
+        object_path = self.object_path(digest)
+        stored_bytes = 0
+        if not os.path.exists(object_path):
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            compressed = zlib.compress(body)
+            self._write_atomically(object_path, compressed)
+            stored_bytes = len(compressed)
+        entry = {"url": url, "digest": digest, "etag": etag, "last_modified": last_modified, "fetched_at": time()}
+        self._write_atomically(self._index_path(url), json.dumps(entry).encode('UTF-8'))
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = self._object_bytes()
+            else:
+                self._total_bytes += stored_bytes
+            evict = self._total_bytes > self.max_bytes
+        if evict:
+            self.evict()
+        return entry
+
+    def touch(self, url, entry):
+        entry["fetched_at"] = time()
+        self._write_atomically(self._index_path(url), json.dumps(entry).encode('UTF-8'))
+
+    def evict(self):
+        with self._lock:
+            entries = []
+            for name in os.listdir(self._index_directory):
+                path = os.path.join(self._index_directory, name)
+                try:
+                    with open(path, 'r', encoding='UTF-8') as file:
+                        entries.append((os.path.getmtime(path), path, json.load(file)["digest"]))
+                except (IOError, ValueError, KeyError):
+                    continue
+            sizes = {}
+            for _, _, digest in entries:
+                if digest not in sizes and os.path.exists(self.object_path(digest)):
+                    sizes[digest] = os.path.getsize(self.object_path(digest))
+            total_bytes = sum(sizes.values())
+            references = Counter(digest for _, _, digest in entries)
+            for _, path, digest in sorted(entries):
+                if total_bytes <= self.max_bytes * self.EVICTION_TARGET:
+                    break
+                os.remove(path)
+                references[digest] -= 1
+                if references[digest] == 0 and digest in sizes:
+                    os.remove(self.object_path(digest))
+                    total_bytes -= sizes.pop(digest)
+            self._total_bytes = total_bytes
+
+    def object_path(self, digest):
+        return os.path.join(self._object_directory, digest[:2], digest + ".z")
+
+    def _object_bytes(self):
+        return sum(os.path.getsize(os.path.join(directory, name))
+                   for directory, _, names in os.walk(self._object_directory) for name in names)
+
+    def _index_path(self, url):
+        return os.path.join(self._index_directory, hashlib.sha1(url.encode('UTF-8')).hexdigest() + ".json")
+
+    def _write_atomically(self, path, data):
+        temporary_path = "{0}.{1}.tmp".format(path, threading.get_ident())
+        with open(temporary_path, 'wb') as file:
+            file.write(data)
+        os.replace(temporary_path, path)
+
+
 class WebRequest(IRequest):
-    def __init__(self, url):
+    """Fetches one url. Connection errors, 429 and 5xx responses count against the url class's circuit breaker and
+    are retried with the retry policy's backoff and budgets; every attempt waits for the rate limiter's slot."""
+    def __init__(self, url, retry_policy=None, session=None, cache=None, metrics=None, rate_limiter=None):
         self._url = url
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.session = session or requests.Session()
+        self.cache = cache
+        self.metrics = metrics if metrics is not None else METRICS
+        self.rate_limiter = rate_limiter
 
     def set_url(self, url):
         self._url = url
 
     def get_data(self, retry_limit=None):
-        try:
-            response = requests.get(self._url, timeout=30)
-            if response.status_code != 200:
-                raise HTTPError(response.status_code)
-            return response.text
-        except RequestException as error:
-            if type(error) == HTTPError:
-                raise error
-            print("Connection timeout.")
-            print("Timeout occurred on link: {0}".format(self._url))
-            if retry_limit and retry_limit > 0:
-                print("{0} retries remaining".format(retry_limit))
-                print("retrying again in 5 minutes")
-                sleep(300)
-                print("retrying...")
-                return self.get_data(retry_limit - 1)
-            elif retry_limit == 0:
-                raise error
-            else:
-                print("retrying in 5 minutes")
-                sleep(300)
+        url_class = self.retry_policy.url_class(self._url)
+        cached = self.cache.lookup(self._url) if self.cache else None
+        if cached and self.cache.is_fresh(cached):
+            self.metrics.increment("cache_hits", url_class=url_class)
+            return self.cache.read(cached)
+        headers = self.cache.validators(cached) if cached else None
+        breaker = self.retry_policy.breaker(url_class)
+        attempt = 0
+        while True:
+            breaker.wait_until_closed()
+            if self.rate_limiter:
+                self.rate_limiter.wait(self._url)
+            try:
+                with self.metrics.timer("http_request_seconds", url_class=url_class):
+                    response = self.session.get(self._url, timeout=30, headers=headers)
+                self.metrics.increment("http_responses", url_class=url_class, status=response.status_code)
+                if response.status_code == 304 and cached:
+                    breaker.record_success()
+                    self.cache.touch(self._url, cached)
+                    return self.cache.read(cached)
+                if response.status_code != 200:
+                    raise requests.HTTPError(response.status_code, response=response)
+                breaker.record_success()
+                if self.cache:
+                    self.cache.store(self._url, response.text, response.headers.get("ETag"),
+                                     response.headers.get("Last-Modified"))
+                return response.text
+            except requests.RequestException as error:
+                status = error.response.status_code if error.response is not None else None
+                if status is not None and status != 429 and status < 500:
+                    raise error
+                breaker.record_failure()
+                self.metrics.increment("fetch_failures", url_class=url_class)
+                if status is None:
+                    print("Connection timeout.")
+                    print("Timeout occurred on link: {0}".format(self._url))
+                else:
+                    print("HTTP {0} on link: {1}".format(status, self._url))
+                if not self.retry_policy.allow_retry(url_class, attempt, retry_limit):
+                    raise error
+                self.metrics.increment("retries", url_class=url_class)
+                delay = max(self.retry_policy.backoff(attempt),
+                            min(_retry_after(error.response), self.retry_policy.max_delay))
+                print("retrying in {0:.0f} seconds".format(delay))
+                sleep(delay)
                 print("retrying...")
-                return self.get_data()
+                attempt += 1
 
     def save_request(self, filename, request_data, encoding='UTF-8'):
         with open(filename, "w", encoding=encoding) as file:
             file.write(request_data)
 
 
+def _retry_after(response):
+    """The seconds a 429 or 503 response's Retry-After header asks for, or 0."""
+    try:
+        return float(response.headers.get("Retry-After", 0))
+    except (AttributeError, TypeError, ValueError):
+        return 0
+
+
 class FileRequest(IRequest):
     def __init__(self, filename):
         self.filename = filename
@@ -60,6 +580,119 @@ class FileRequest(IRequest):
             return file.read()
 
 
+class ReplayRequest(FileRequest):
+    """Serves urls out of a ResponseCache only, so a stored crawl can be re-parsed offline."""
+    def __init__(self, cache, url=None):
+        super(ReplayRequest, self).__init__(None)
+        self.cache = cache
+        self.set_url(url)
+
+    def set_url(self, url):
+        self._url = url
+        self.entry = self.cache.lookup(url) if url else None
+        self.filename = self.cache.object_path(self.entry["digest"]) if self.entry else None
+
+    def get_data(self):
+        if self.entry is None:
+            # replayed like the 404 the live site answered, which was never cached
+            raise requests.HTTPError(404, "{0} is not in the response cache".format(self._url))
+        with open(self.filename, 'rb') as file:
+            return zlib.decompress(file.read()).decode('UTF-8')
+
+
+class RateLimiter(object):
+    """Spaces out requests to the same host so that at most requests_per_second are started."""
+    def __init__(self, requests_per_second=None):
+        self.interval = 1.0 / requests_per_second if requests_per_second else 0
+        self._lock = threading.Lock()
+        self._next_slot = {}
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+
+class Fetcher(object):
+    """The session, rate limiter, retry policy and cache a controller fetches pages through."""
+    def __init__(self, concurrency=1, requests_per_second=None, retry_policy=None, cache=None, replay=False,
+                 metrics=None):
+        if replay and cache is None:
+            raise ValueError("replay needs a ResponseCache to read from")
+        self.rate_limiter = RateLimiter(requests_per_second)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.session = create_session(max(1, concurrency))
+        self.cache = cache
+        self.replay = replay
+        self.metrics = metrics if metrics is not None else METRICS
+
+    def fetch(self, url):
+        if self.replay:
+            return ReplayRequest(self.cache, url).get_data()
+        return WebRequest(url, self.retry_policy, self.session, self.cache, self.metrics,
+                          self.rate_limiter).get_data()
+
+
+class SharedFetcher(Fetcher):
+    """A Fetcher shared by several controllers that fetches each entry page and element document only once.
+
+    Those urls are the same whichever league a manager is crawled for, so a request already in flight is waited on
+    and finished ones are kept, zlib compressed, for the controllers that ask later, up to max_bytes of them with the
+    least recently used dropped first. An entry page compresses to around 30KB, so the default keeps roughly the
+    last two thousand. Standings pages
+    are never shared.
+    """
+    SHARED_URLS = re.compile(r'/entry/|/web/api/elements/')
+
+    def __init__(self, concurrency=1, requests_per_second=None, retry_policy=None, cache=None, replay=False,
+                 metrics=None, max_bytes=64 * 2 ** 20):
+        super(SharedFetcher, self).__init__(concurrency, requests_per_second, retry_policy, cache, replay, metrics)
+        self.max_bytes = max_bytes
+        self._pages = OrderedDict()
+        self._sizes = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def fetch(self, url):
+        if not self.SHARED_URLS.search(url):
+            return super(SharedFetcher, self).fetch(url)
+        with self._lock:
+            page = self._pages.get(url)
+            if page is None:
+                page = self._pages[url] = Future()
+                owner = True
+            else:
+                self._pages.move_to_end(url)
+                owner = False
+        if not owner:
+            self.metrics.increment("shared_fetch_hits")
+            return zlib.decompress(page.result()).decode('UTF-8')
+        try:
+            page_html = super(SharedFetcher, self).fetch(url)
+        except BaseException as error:
+            with self._lock:
+                if self._pages.get(url) is page:
+                    del self._pages[url]
+            page.set_exception(error)
+            raise
+        compressed = zlib.compress(page_html.encode('UTF-8'))
+        page.set_result(compressed)
+        with self._lock:
+            if self._pages.get(url) is page:
+                self._sizes[url] = len(compressed)
+                self._bytes += len(compressed)
+            while self._bytes > self.max_bytes:
+                evicted, _ = self._pages.popitem(last=False)
+                self._bytes -= self._sizes.pop(evicted, 0)
+        return page_html
+
+
 class LinkParser(object):
     def __init__(self):
         self.id_re_object = re.compile(r'[0-9]+')
@@ -79,7 +712,11 @@ class Scraper(object):
         self.set_source_data(data)
 
     def set_source_data(self, data):
-        self.parser = BeautifulSoup(data)
+        self.parser = bs4.BeautifulSoup(data)
+
+
+StandingsRow = namedtuple('StandingsRow', ['rank', 'link', 'team_name', 'manager_name', 'game_week_points',
+                                           'total_points'])
 
 
 class StandingsScraper(Scraper):
@@ -87,105 +724,201 @@ class StandingsScraper(Scraper):
         css_selector = 'table.ismStandingsTable tr td a[href]'
         return [anchor_tag.attrs.get('href') for anchor_tag in self.parser.select(css_selector)]
 
-
-class EntryScraper(Scraper):
+    def scrape_standings_rows(self):
+        rows = []
+        for table_row in self.parser.select('table.ismStandingsTable tr'):
+            cells = table_row.find_all('td')
+            anchor_tag = cells[2].find('a', href=True) if len(cells) >= 6 else None
+            if anchor_tag is None:
+                continue
+            rows.append(StandingsRow(_def_list_number(cells[1].get_text()), anchor_tag.attrs.get('href'),
+                                     anchor_tag.get_text().strip(), cells[3].get_text().strip(),
+                                     _def_list_number(cells[4].get_text()), _def_list_number(cells[5].get_text())))
+        return rows
+
+
+_STANDINGS_ROW = re.compile(r'<tr\b[^>]*>\s*<td\b[^>]*>(?:[^<]|<(?!/td>))*</td>\s*'
+                            r'<td\b[^>]*>\s*([0-9,]+)\s*</td>\s*'
+                            r'<td\b[^>]*>\s*<a\b[^>]*?\shref\s*=\s*["\'](/entry/[0-9]+/[^"\']*)["\'][^>]*>'
+                            r'([^<]*)</a>\s*</td>\s*<td\b[^>]*>([^<]*)</td>\s*'
+                            r'<td\b[^>]*>\s*(-?[0-9,]+)\s*</td>\s*<td\b[^>]*>\s*(-?[0-9,]+)\s*</td>', re.I)
+
+
+def extract_standings_rows(standings_html):
+    """The rows StandingsScraper.scrape_standings_rows returns, read with one regular expression pass instead of a
+    BeautifulSoup tree, for crawls that read nothing else from the page.
+
+    If the standings table holds more entry links than the expression matched rows, the markup has drifted from
+    what it expects and the page is read with StandingsScraper instead.
+    """
+    rows = [StandingsRow(_def_list_number(rank), link, unescape(team_name).strip(), unescape(manager_name).strip(),
+                         _def_list_number(game_week_points), _def_list_number(total_points))
+            for rank, link, team_name, manager_name, game_week_points, total_points
+            in _STANDINGS_ROW.findall(standings_html)]
+    table_start = standings_html.find("ismStandingsTable")
+    if table_start != -1:
+        table_end = standings_html.find("</table>", table_start)
+        if standings_html.count("/entry/", table_start, table_end if table_end != -1 else len(standings_html)) \
+                != len(rows):
+            return StandingsScraper(standings_html).scrape_standings_rows()
+    return rows
+
+
+EntryRecord = namedtuple('EntryRecord', [
+    'manager_name', 'team_name', 'club', 'country',
+    'overall_points', 'overall_rank', 'total_players', 'game_week_points', 'total_transfers', 'game_week_transfers',
+    'wild_card_used', 'team_value', 'bank',
+    'player_ids', 'names', 'positions', 'captain_index', 'vice_captain_index', 'squad_game_week'])
+
+EMPTY_ENTRY = EntryRecord("", "", "None", "None", None, None, None, None, None, None, None, None, None,
+                          (), (), (), None, None, None)
+
+
+def _classes(element):
+    return element.get('class', '').split()
+
+
+def _def_list_number(text):
+    return int(text.strip().replace(',', ''))
+
+
+def _def_list_money(text):
+    return Decimal(text.strip().strip("£m"))
+
+
+def parse_entry(page_html):
+    """Extracts everything we store from an entry page with a single lxml parse and a single walk of the tree.
+
+    The def list holds, in order: overall points, overall rank, total players, gameweek points, total transfers,
+    gameweek transfers, wildcard, team value and bank.
+    """
+    if not page_html or not page_html.strip():
+        return EMPTY_ENTRY
+    fields = {}
+    def_list = []
+    player_ids, names, positions = [], [], []
+    captain_index = vice_captain_index = None
+    for element in lxml.html.document_fromstring(page_html).iter('div', 'dt', 'dd', 'a', 'h1', 'h2', 'img'):
+        tag = element.tag
+        if tag == 'div':
+            element_class = element.get('class', '')
+            if element_class.lstrip().startswith('ismPitchElement'):
+                pitch_data = json.loads(element_class[element_class.index('{'):])
+                if pitch_data.get('is_captain'):
+                    captain_index = len(positions)
+                if pitch_data.get('is_vice_captain'):
+                    vice_captain_index = len(positions)
+                positions.append(pitch_data['pos'])
+        elif tag == 'dt':
+            if 'ismElementDetail' in _classes(element.getparent()):
+                names.append(element.text_content().strip())
+        elif tag == 'dd':
+            parent_classes = _classes(element.getparent())
+            if 'ismDefList' in parent_classes and 'ismRHSDefList' in parent_classes:
+                def_list.append(element.text_content())
+        elif tag == 'a':
+            if 'JS_ISM_INFO' in _classes(element.getparent()):
+                player_ids.append(int(element.get('href')[1:]))
+        elif tag == 'h1':
+            element_classes = _classes(element)
+            if 'manager_name' not in fields and 'ismSection2' in element_classes and 'ismWrapText' in element_classes:
+                fields['manager_name'] = element.text_content()
+        elif tag == 'h2':
+            if 'team_name' not in fields and 'ismSection3' in _classes(element):
+                fields['team_name'] = element.text_content()
+        elif tag == 'img':
+            element_classes = _classes(element)
+            if 'club' not in fields and 'ismRHSBadge' in element_classes:
+                fields['club'] = element.get('alt')
+            elif 'country' not in fields and 'ismRHSNat' in element_classes:
+                fields['country'] = element.get('alt')
+
+    if len(def_list) >= 9:
+        fields.update(overall_points=_def_list_number(def_list[0]), overall_rank=_def_list_number(def_list[1]),
+                      total_players=_def_list_number(def_list[2]), game_week_points=_def_list_number(def_list[3]),
+                      total_transfers=_def_list_number(def_list[4]), game_week_transfers=_def_list_number(def_list[5]),
+                      wild_card_used="Not" in def_list[6], team_value=_def_list_money(def_list[7]),
+                      bank=_def_list_money(def_list[8]))
+    return EMPTY_ENTRY._replace(player_ids=tuple(player_ids), names=tuple(names), positions=tuple(positions),
+                                captain_index=captain_index, vice_captain_index=vice_captain_index, **fields)
+
+
+def timed_parse_entry(page_html):
+    """parse_entry and the seconds it took, for parses run in another process."""
+    started = perf_counter()
+    record = parse_entry(page_html)
+    return record, perf_counter() - started
+
+
+class EntryScraper(object):
+    """Thin accessors over the EntryRecord that parse_entry builds for the current page."""
     def __init__(self, page_html):
-        super(EntryScraper, self).__init__(page_html)
-        self.pitch_elements = []
         self.set_source_data(page_html)
 
     def set_source_data(self, page_html):
-        super(EntryScraper, self).set_source_data(page_html)
-        pitch_css_selector = 'div.ismPitchElement'
-        self.pitch_elements = [anchor_tag.attrs.get('class') for anchor_tag in self.parser.select(pitch_css_selector)]
-        manager_transfers_css_selector = 'dl.ismDefList.ismRHSDefList dd'
-        self.rankings_points_transfers = self.parser.select(manager_transfers_css_selector)
+        self.record = parse_entry(page_html)
+
+    def set_record(self, record):
+        self.record = record
 
     def scape_player_positions(self):
-        POSITION_INDEX = -4
-        return [int(item[POSITION_INDEX].strip(",")) for item in self.pitch_elements]
+        return list(self.record.positions)
 
     def scrape_names(self):
-        return [BeautifulSoup(str(item)).string.strip() for item in self.parser.select('div.ismPitchElement dt')]
+        return list(self.record.names)
 
     def scrape_player_ids(self):
-        return [int(a.attrs.get('href')[1:]) for a in self.parser.select('span.JS_ISM_INFO a')]
+        return list(self.record.player_ids)
 
     def scrape_vice_captain_index(self):
-        VICE_CAPTAIN = -6
-        return self._scrape_captain_squad_index(VICE_CAPTAIN)
+        return self.record.vice_captain_index
 
     def scrape_captain_index(self):
-        CAPTAIN = -10
-        return self._scrape_captain_squad_index(CAPTAIN)
+        return self.record.captain_index
 
     def scrape_overall_points(self):
-        OVERALL_POINTS = 0
-        return BeautifulSoup(str(self.rankings_points_transfers[OVERALL_POINTS])).text.replace(',', '')
+        return self.record.overall_points
 
     def scrape_overall_rank(self):
-        OVERALL_RANK = 1
-        return BeautifulSoup(str(self.rankings_points_transfers[OVERALL_RANK])).text.replace(',', '')
+        return self.record.overall_rank
 
     def scrape_total_players(self):
-        TOTAL_PLAYERS = 2
-        return BeautifulSoup(str(self.rankings_points_transfers[TOTAL_PLAYERS])).text.replace(',', '')
+        return self.record.total_players
 
     def scrape_game_week_points(self):
-        GAME_WEEK_POINTS = 3
-        return BeautifulSoup(str(self.rankings_points_transfers[GAME_WEEK_POINTS])).text.replace(',', '')
+        return self.record.game_week_points
 
     def scrape_total_transfers(self):
-        TOTAL_TRANSFERS = 4
-        return BeautifulSoup(str(self.rankings_points_transfers[TOTAL_TRANSFERS])).text.replace(',', '')
+        return self.record.total_transfers
 
     def scrape_game_week_transfers(self):
-        GAME_WEEK_TRANSFERS = 5
-        return BeautifulSoup(str(self.rankings_points_transfers[GAME_WEEK_TRANSFERS])).text.replace(',', '')
+        return self.record.game_week_transfers
 
     def scrape_wild_card_used(self):
-        WILD_CARD = 6
-        return "Not" in BeautifulSoup(str(self.rankings_points_transfers[WILD_CARD])).text
+        return self.record.wild_card_used
 
     def scrape_team_value(self):
-        TEAM_VALUE = 7
-        return BeautifulSoup(str(self.rankings_points_transfers[TEAM_VALUE])).text.strip("£m")
+        return self.record.team_value
 
     def scrape_bank(self):
-        BANK = 8
-        return BeautifulSoup(str(self.rankings_points_transfers[BANK])).text.strip("£m")
+        return self.record.bank
 
     def scrape_team_name(self):
-        css_selector = 'h2.ismSection3'
-        return BeautifulSoup(str(self.parser.select(css_selector)[0])).text
+        return self.record.team_name
 
     def scrape_manager_name(self):
-        css_selector = "h1.ismSection2.ismWrapText"
-        return BeautifulSoup(str(self.parser.select(css_selector)[0])).text
+        return self.record.manager_name
 
     def scrape_favorite_club(self):
-        try:
-            css_selector = 'img.ismRHSBadge'
-            club_img_tag = self.parser.select(css_selector)[0]
-            return club_img_tag.get('alt')
-        except IndexError:
-            return "None"
+        return self.record.club
 
     def scrape_country(self):
-        try:
-            css_selector = 'img.ismRHSNat'
-            club_img_tag = self.parser.select(css_selector)[0]
-            return club_img_tag.get('alt')
-        except IndexError:
-            return "None"
-
-    def _scrape_captain_squad_index(self, captain_code):
-        """CAPTAIN = -10 & VICE_CAPTAIN = -6 """
-        player_is_captain = [item[captain_code].strip(",") for item in self.pitch_elements]
-        return player_is_captain.index("true")
+        return self.record.country
 
 
 class Manager(object):
+    __slots__ = ("id", "name", "club", "country", "team_name", "finance", "team")
+
     def __init__(self):
         self.id = 0
         self.name = ""
@@ -197,6 +930,8 @@ class Manager(object):
 
 
 class Finance(object):
+    __slots__ = ("total_transfers", "week_transfers", "wildcard_available", "worth", "bank")
+
     def __init__(self):
         self.total_transfers = ""
         self.week_transfers = 0
@@ -205,41 +940,104 @@ class Finance(object):
         self.bank = 0
 
 
-class GameWeekTeam(object):
+class Player(object):
+    __slots__ = ("name", "playerID")
+
+    def __init__(self, player_id=0, name=""):
+        self.name = name
+        self.playerID = player_id
+
+    def __str__(self):
+        return self.name
+
+
+class PlayerRegistry(object):
+    """Season wide table of players so every squad that picks a player shares one Player instance. A player first
+    looked up by id alone gets their name from the first intern() that knows it."""
     def __init__(self):
+        self._players = {}
+
+    def __len__(self):
+        return len(self._players)
+
+    def intern(self, player_id, name=""):
+        player = self._players.get(player_id)
+        if player is None:
+            player = self._players[player_id] = Player(player_id, name)
+        elif name and not player.name:
+            player.name = name
+        return player
+
+    def get(self, player_id):
+        return self._players.get(player_id) or self.intern(player_id)
+
+
+class SquadPlayer(namedtuple('SquadPlayer', ['player', 'position', 'started'])):
+    """A player as picked in one squad."""
+    __slots__ = ()
+
+    @property
+    def playerID(self):
+        return self.player.playerID
+
+    @property
+    def name(self):
+        return self.player.name
+
+    def __str__(self):
+        return self.player.name
+
+
+class GameWeekTeam(object):
+    """The squad is kept as a flat array of (player_id, position, started) triples; players, captain and
+    vice_captain are built from it on demand. squad_game_week is set when the squad was carried forward from the
+    gameweek whose Position rows still hold it."""
+    __slots__ = ("overall_points", "overall_rank", "game_week_points", "squad", "captain_index",
+                 "vice_captain_index", "squad_game_week", "registry")
+    SQUAD_FIELDS = 3
+
+    def __init__(self, registry=None):
         self.overall_points = 0
         self.overall_rank = 0
         self.game_week_points = 0
-        self.players = []
-        self.captain = None
-        self.vice_captain = None
+        self.squad = array('i')
+        self.captain_index = None
+        self.vice_captain_index = None
+        self.squad_game_week = None
+        # without a crawl's registry the team keeps its own, rather than one that outlives every season
+        self.registry = registry if registry is not None else PlayerRegistry()
+
+    @property
+    def players(self):
+        squad = self.squad
+        return [SquadPlayer(self.registry.get(squad[i]), squad[i + 1], bool(squad[i + 2]))
+                for i in range(0, len(squad), self.SQUAD_FIELDS)]
+
+    @property
+    def captain(self):
+        return self._squad_player(self.captain_index)
+
+    @property
+    def vice_captain(self):
+        return self._squad_player(self.vice_captain_index)
 
     def create_players(self, player_ids, player_names, player_positions):
+        team_size = 11
         for i in range(len(player_ids)):
-            p = Player()
-            p.playerID = player_ids[i]
-            p.name = player_names[i]
-            p.position = player_positions[i]
-            team_size = 11
-            if i < team_size:
-                p.started = True
-            self.players.append(p)
+            self.registry.intern(player_ids[i], player_names[i])
+            self.squad.extend((player_ids[i], player_positions[i], int(i < team_size)))
 
     def set_captain(self, captain_index):
-        self.captain = self.players[captain_index]
+        self.captain_index = captain_index
 
     def set_vice_captain(self, vice_captain_index):
-        self.vice_captain = self.players[vice_captain_index]
-
-class Player(object):
-    def __init__(self):
-        self.name = ""
-        self.playerID = 0
-        self.position = 0
-        self.started = False
+        self.vice_captain_index = vice_captain_index
 
-    def __str__(self):
-        return self.name
+    def _squad_player(self, index):
+        if index is None:
+            return None
+        i = index * self.SQUAD_FIELDS
+        return SquadPlayer(self.registry.get(self.squad[i]), self.squad[i + 1], bool(self.squad[i + 2]))
 
 
 class PlayerStats(object):
@@ -264,128 +1062,1699 @@ class PlayerStats(object):
             self.attributes_dict[attribute] = Decimal(self.attributes_dict[attribute])
 
 
-class DbSaver(object):
-    def __init__(self, game_week, connection_string, season=1415):
-        # TODO refactor gameweek and season out of this class
-        cnxn = pyodbc.connect(connection_string, autocommit=True)
-        self.cursor = cnxn.cursor()
-        self.sql_statements = ""
+PLAYER_COLUMNS = ("id", "web_name", "game_week", "season", "event_total", "type_name", "team_name", "selected_by",
+                  "total_points", "team_code", "news", "team_id", "first_name", "second_name", "now_cost",
+                  "chance_of_playing_this_round", "chance_of_playing_next_round", "value_form", "value_season",
+                  "in_dreamteam", "dreamteam_count", "selected_by_percent", "form", "transfers_out", "transfers_in",
+                  "points_per_game", "minutes", "goals_scored", "assists", "clean_sheets", "goals_conceded",
+                  "own_goals", "penalties_saved", "penalties_missed", "yellow_cards", "red_cards", "saves", "bonus",
+                  "ea_index", "bps", "element_type", "team")
+
+PLAYER_DECIMAL_COLUMNS = frozenset(["selected_by", "value_form", "value_season", "selected_by_percent", "form",
+                                    "points_per_game"])
+
+
+class PlayerBatch(object):
+    """Columnar buffer holding just the Player table columns for a whole roster."""
+    def __init__(self, game_week, season):
+        self.game_week = game_week
+        self.season = season
+        self.columns = dict((column, []) for column in PLAYER_COLUMNS)
+
+    def __len__(self):
+        return len(self.columns["id"])
+
+    @property
+    def column_names(self):
+        return list(self.columns)
+
+    def append(self, document):
+        for column, values in self.columns.items():
+            if column == "game_week":
+                value = self.game_week
+            elif column == "season":
+                value = self.season
+            else:
+                value = document.get(column)
+            if value is False or value is None:
+                value = 0
+            elif value is True:
+                value = 1
+            elif column in PLAYER_DECIMAL_COLUMNS:
+                value = Decimal(str(value))
+            values.append(value)
+
+    def rows(self, columns=None):
+        return list(zip(*[self.columns[column] for column in (columns or self.columns)]))
+
+    def digests(self):
+        """A digest of each player's stats, leaving out the game_week and season they were fetched in."""
+        stats_columns = [column for column in self.columns if column not in ("game_week", "season")]
+        return dict((row[0], hashlib.sha1(repr(row).encode('UTF-8')).hexdigest())
+                    for row in self.rows(stats_columns))
+
+    def select(self, player_ids):
+        selected = PlayerBatch(self.game_week, self.season)
+        keep = [index for index, player_id in enumerate(self.columns["id"]) if player_id in player_ids]
+        for column, values in self.columns.items():
+            selected.columns[column] = [values[index] for index in keep]
+        return selected
+
+
+class SqlDialect(object):
+    """Builds the parameterised statements DbSaver hands to executemany. Placeholders are qmark style for both
+    pypyodbc and sqlite3."""
+    def insert(self, table, columns):
+        return "INSERT INTO {0} ({1}) VALUES ({2})".format(table, ", ".join(columns), self._placeholders(columns))
+
+    def insert_if_absent(self, table, columns, keys):
+        """Takes the row followed by its key values."""
+        selected = ", ".join("? AS {0}".format(column) for column in columns)
+        matched = " AND ".join("{0} = ?".format(key) for key in keys)
+        return ("INSERT INTO {0} ({1}) SELECT * FROM (SELECT {2}) AS tmp "
+                "WHERE NOT EXISTS (SELECT * FROM {0} WHERE {3})").format(table, ", ".join(columns), selected, matched)
+
+    def upsert(self, table, columns, keys):
+        raise NotImplementedError
+
+    def _placeholders(self, columns):
+        return ", ".join("?" for _ in columns)
+
+
+class MySqlDialect(SqlDialect):
+    def upsert(self, table, columns, keys):
+        updates = ", ".join("{0}=VALUES({0})".format(column) for column in columns if column not in keys)
+        return "{0} ON DUPLICATE KEY UPDATE {1}".format(self.insert(table, columns), updates)
+
+
+class SqlServerDialect(SqlDialect):
+    def upsert(self, table, columns, keys):
+        selected = ", ".join("? AS {0}".format(column) for column in columns)
+        matched = " AND ".join("target.{0} = source.{0}".format(key) for key in keys)
+        updates = ", ".join("{0} = source.{0}".format(column) for column in columns if column not in keys)
+        values = ", ".join("source." + column for column in columns)
+        return ("MERGE INTO {0} AS target USING (SELECT {1}) AS source ON {2} "
+                "WHEN MATCHED THEN UPDATE SET {3} "
+                "WHEN NOT MATCHED THEN INSERT ({4}) VALUES ({5});").format(table, selected, matched, updates,
+                                                                           ", ".join(columns), values)
+
+
+class SqliteDialect(SqlDialect):
+    def upsert(self, table, columns, keys):
+        updates = ", ".join("{0}=excluded.{0}".format(column) for column in columns if column not in keys)
+        return "{0} ON CONFLICT ({1}) DO UPDATE SET {2}".format(self.insert(table, columns), ", ".join(keys), updates)
+
+
+def dialect_for(connection_string):
+    if connection_string.startswith("sqlite:"):
+        return SqliteDialect()
+    if "sql server" in connection_string.lower():
+        return SqlServerDialect()
+    return MySqlDialect()
+
+
+class TableBuffer(object):
+    """Typed rows waiting to be written to one table with one statement."""
+    def __init__(self, table, columns, mode="insert", keys=()):
+        self.table = table
+        self.columns = tuple(columns)
+        self.mode = mode
+        self.keys = tuple(keys)
+        self.rows = []
+
+    def statement(self, dialect):
+        if self.mode == "upsert":
+            return dialect.upsert(self.table, self.columns, self.keys)
+        if self.mode == "insert_if_absent":
+            return dialect.insert_if_absent(self.table, self.columns, self.keys)
+        return dialect.insert(self.table, self.columns)
+
+    def parameters(self, row):
+        if self.mode == "insert_if_absent":
+            return tuple(row) + tuple(row[self.columns.index(key)] for key in self.keys)
+        return tuple(row)
+
+
+class StorageHandler(object):
+    """Buffers typed rows per table between commits; subclasses decide where commit writes them."""
+    # every write is an upsert or an insert-if-absent so a page can be replayed after a crash
+    # foreign keys are satisfied when tables are flushed in this order
+    TABLE_ORDER = ["Manager", "Player", "GameWeekTeam", "Position", "Finance"]
+
+    def __init__(self, game_week, season=1415, metrics=None):
         self.game_week = game_week
         self.season = season
+        self.metrics = metrics if metrics is not None else METRICS
+        self.tables = {}
+        self._create_table_buffers()
 
     def add_manager(self, manager):
-        sql = ("INSERT INTO Manager (managerID, name, club, team_name, country, season) "
-               "SELECT * FROM (SELECT {0} as managerID, '{1}' as name, '{2}' as club, '{3}' as team_name, "
-               "'{4}' as country, {5} as season) AS tmp "
-               "WHERE NOT EXISTS ( SELECT * from manager where managerID={0} and season={5} )"
-               "; ").format(manager.id, manager.name.replace("'", "''"), manager.club.replace("'", "''"),
-                            manager.team_name.replace("'", "''"), manager.country.replace("'", "''"), self.season)
-        self.sql_statements += sql
+        self.tables["Manager"].rows.append((int(manager.id), manager.name, manager.club, manager.team_name,
+                                            manager.country, self.season))
 
     def add_finance(self, finance, manager_id):
-        wildcard_available = 0
-        if finance.wildcard_available:
-            wildcard_available = 1
-        sql = ("insert into Finance( game_week, total_transfers, week_transfers, wildcard_available, worth,"
-               "bank, managerID, season) values({0}, {1}, {2}, {3}, {4}, {5}, {6}, {7} )"
-               "; ").format(self.game_week, finance.total_transfers, finance.week_transfers, wildcard_available,
-                            finance.worth, finance.bank, manager_id, self.season)
-        self.sql_statements += sql
+        self.tables["Finance"].rows.append((self.game_week, finance.total_transfers, finance.week_transfers,
+                                            int(bool(finance.wildcard_available)), finance.worth, finance.bank,
+                                            int(manager_id), self.season))
 
     def add_player_stats(self, player_stats):
-        field_names = []
-        values = []
-
-        for key, value in player_stats.attributes_dict.items():
-            field_names.append(key)
+        values = dict(player_stats.attributes_dict, game_week=self.game_week, season=self.season)
+        table = self.tables.get("Player")
+        if table is None:
+            table = TableBuffer("Player", list(values), "upsert", ["id"])
+            self.tables["Player"] = table
+        row = []
+        for column in table.columns:
+            value = values.get(column)
             if value is False or value is None:
                 value = 0
             if value is True:
                 value = 1
-            values.append(value)
-        field_names += ["game_week", "season"]
-
-        sql = "insert into Player({0}) values (".format(', '.join(field_names))
-        for value in values:
-            if type(value) == str:
-                sql += "'{0}',".format(value.replace("'", "''"))
-            else:
-                sql += "{0}, ".format(value)
-        sql += "{0}, {1})".format(self.game_week, self.season)
-
-        sql += "ON DUPLICATE KEY UPDATE "
-        LAST_FIELD = -1
-        for field in field_names[:LAST_FIELD]:
-            sql += "{0}=VALUES({0}),".format(field)
-        sql += "{0}=VALUES({0});".format(field_names[LAST_FIELD])
-        self.sql_statements += sql.replace('""', 'null')
+            row.append(value)
+        table.rows.append(tuple(row))
+
+    def add_player_batch(self, player_batch):
+        table = self.tables.get("Player")
+        if table is None or not table.rows:
+            table = TableBuffer("Player", player_batch.column_names, "upsert", ["id"])
+            self.tables["Player"] = table
+        table.rows.extend(player_batch.rows(table.columns))
+
+    def add_entry(self, manager, team):
+        """Buffers a manager's rows for the gameweek. A squad carried forward only needs its GameWeekTeam row: the
+        manager and the Position rows were stored with the gameweek it points at."""
+        if team.squad_game_week is None:
+            self.add_manager(manager)
+        self.add_game_week_team(team, manager.id)
+        if team.squad_game_week is None:
+            for player in team.players:
+                self.add_player(player, manager.id)
 
     def add_game_week_team(self, team, manager_id):
         game_week_team_id = str(manager_id) + "-" + str(self.game_week)
-        sql = ("insert into GameWeekTeam (gameWeekTeamID, game_week, overall_points, overall_rank, game_week_points,"
-               "captainID, vice_captainID, managerID, season) "
-               "values('{0}', {1}, {2}, {3}, {4}, {5}, {6}, {7}, {8})"
-               "; ").format(game_week_team_id, self.game_week, team.overall_points, team.overall_rank,
-                            team.game_week_points, team.captain.playerID, team.vice_captain.playerID, manager_id,
-                            self.season)
-
-        self.sql_statements += sql
+        squad_game_week = team.squad_game_week if team.squad_game_week is not None else self.game_week
+        self.tables["GameWeekTeam"].rows.append((game_week_team_id, self.game_week, team.overall_points,
+                                                 team.overall_rank, team.game_week_points, squad_game_week,
+                                                 team.captain.playerID, team.vice_captain.playerID, int(manager_id),
+                                                 self.season))
 
     def add_player(self, player, manager_id):
         game_week_team_id = str(manager_id) + "-" + str(self.game_week)
-        started = 0
-        if player.started:
-            started = 1
-        sql = ("insert into Position (id, gameWeekTeamID, started ) "
-               "values({0}, '{1}', {2}); ").format(player.playerID, game_week_team_id, started)
-        self.sql_statements += sql
+        self.tables["Position"].rows.append((player.playerID, game_week_team_id, int(bool(player.started))))
 
     def commit(self):
-        if self.sql_statements:
-            with open(r"Execution_log.sql", "a", encoding='UTF-8') as my_file:
-                my_file.write(self.sql_statements)
-            self.sql_statements = self.sql_statements.replace("True", "1")
-            self.sql_statements = self.sql_statements.replace("False", "0")
+        raise NotImplementedError
+
+    def _buffered_tables(self):
+        return [self.tables[name] for name in self.TABLE_ORDER if name in self.tables and self.tables[name].rows]
+
+    def _create_table_buffers(self):
+        self.tables["Manager"] = TableBuffer("Manager", ["managerID", "name", "club", "team_name", "country",
+                                                         "season"], "insert_if_absent", ["managerID", "season"])
+        self.tables["Finance"] = TableBuffer("Finance", ["game_week", "total_transfers", "week_transfers",
+                                                         "wildcard_available", "worth", "bank", "managerID",
+                                                         "season"], "insert_if_absent",
+                                             ["managerID", "game_week", "season"])
+        self.tables["GameWeekTeam"] = TableBuffer("GameWeekTeam", ["gameWeekTeamID", "game_week", "overall_points",
+                                                                   "overall_rank", "game_week_points",
+                                                                   "squad_game_week", "captainID", "vice_captainID",
+                                                                   "managerID", "season"],
+                                                  "upsert", ["gameWeekTeamID"])
+        self.tables["Position"] = TableBuffer("Position", ["id", "gameWeekTeamID", "started"], "insert_if_absent",
+                                              ["id", "gameWeekTeamID"])
+
+
+class StatementLog(object):
+    """Sampled, size capped replacement for appending every committed row to Execution_log.sql.
+
+    Each commit logs its statements and every sample_every'th row; sample_every=0 logs statements only and None
+    turns the log off. Once the file grows past max_bytes it is rotated to filename.1, keeping backups old files.
+    """
+    _lock = threading.Lock()
+
+    def __init__(self, filename="Execution_log.sql", sample_every=100, max_bytes=10 * 1024 ** 2, backups=3):
+        self.filename = filename
+        self.sample_every = sample_every
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._rows_seen = 0
+
+    def write(self, tables, dialect):
+        if self.sample_every is None:
+            return
+        lines = []
+        for table in tables:
+            lines.append("{0};\n".format(table.statement(dialect)))
+            if self.sample_every:
+                skipped = -self._rows_seen % self.sample_every
+                lines.extend("-- {0!r}\n".format(row) for row in table.rows[skipped::self.sample_every])
+            self._rows_seen += len(table.rows)
+        with self._lock:
+            self._rotate()
+            with open(self.filename, "a", encoding='UTF-8') as my_file:
+                my_file.write("".join(lines))
+
+    def _rotate(self):
+        try:
+            if os.path.getsize(self.filename) < self.max_bytes:
+                return
+        except OSError:
+            return
+        for i in range(self.backups - 1, 0, -1):
+            if os.path.exists("{0}.{1}".format(self.filename, i)):
+                os.replace("{0}.{1}".format(self.filename, i), "{0}.{1}".format(self.filename, i + 1))
+        if self.backups:
+            os.replace(self.filename, self.filename + ".1")
+        else:
+            os.remove(self.filename)
+
+
+class DbSaver(StorageHandler):
+    def __init__(self, game_week, connection_string, season=1415, batch_size=1000, dialect=None, metrics=None,
+                 statement_log=None, reconnect_attempts=3, reconnect_delay=1):
+        # TODO refactor gameweek and season out of this class
+        super(DbSaver, self).__init__(game_week, season, metrics)
+        self.connection_string = connection_string
+        self.connection = self._connect(connection_string)
+        self.cursor = self.connection.cursor()
+        self.dialect = dialect or dialect_for(connection_string)
+        self.batch_size = batch_size
+        self.statement_log = statement_log or StatementLog()
+        self.reconnect_attempts = reconnect_attempts
+        self.reconnect_delay = reconnect_delay
+
+    def commit(self):
+        """Writes the buffered rows, returning how many of them the database rejected."""
+        tables = self._buffered_tables()
+        if not tables:
+            return 0
+        rejected = self.write(tables)
+        for table in tables:
+            table.rows = []
+        return rejected
+
+    def write(self, tables):
+        """Writes the rows of tables in one transaction, one executemany per table and batch, and returns how many
+        rows were rejected. If the transaction fails the rows are retried one at a time so a single bad row only
+        costs itself. If the connection was lost it is reopened, up to reconnect_attempts times, and the
+        transaction run again."""
+        self.statement_log.write(tables, self.dialect)
+        started = perf_counter()
+        attempt = 0
+        rejected = 0
+        while True:
             try:
-                self.cursor.execute(self.sql_statements)
-            except pyodbc.Error as e:
-                print(e)
-                with open(r"Exceptions.txt", "a", encoding='UTF-8') as my_file:
-                    except_log_msg = ("\n\n\n------------------Error---------------------\n\n"
-                                      + str(e) + "\n\n")
-                    for s in self.sql_statements.split(";"):
-                        except_log_msg += s + ";\n"
-                    my_file.write(except_log_msg)
-            self.sql_statements = ""
+                self._execute(tables)
+                break
+            except self.database_errors as e:
+                if self._connection_alive():
+                    print(e)
+                    self.metrics.increment("db_batch_failures")
+                    self.connection.rollback()
+                    rejected = self._commit_row_by_row(tables, e)
+                    break
+                if attempt >= self.reconnect_attempts:
+                    raise
+                attempt += 1
+                sleep(self.reconnect_delay * attempt)
+                self._reconnect()
+        self.metrics.observe("db_commit_seconds", perf_counter() - started)
+        for table in tables:
+            self.metrics.increment("db_rows", len(table.rows), table=table.table)
+        return rejected
+
+    def close(self):
+        try:
+            self.connection.close()
+        except self.database_errors:
+            pass
+
+    def _execute(self, tables):
+        for table in tables:
+            statement = table.statement(self.dialect)
+            for start in range(0, len(table.rows), self.batch_size):
+                batch = table.rows[start:start + self.batch_size]
+                self.cursor.executemany(statement, [table.parameters(row) for row in batch])
+        self.connection.commit()
+
+    def _connection_alive(self):
+        try:
+            self.connection.rollback()
+            self.connection.cursor().execute("SELECT 1")
+            return True
+        except self.database_errors:
+            return False
+
+    def _reconnect(self):
+        self.metrics.increment("db_reconnects")
+        self.close()
+        try:
+            self.connection = self._connect(self.connection_string)
+            self.cursor = self.connection.cursor()
+        except self.database_errors as e:
+            print("Reconnecting failed: {0}".format(e))
+
+    def _commit_row_by_row(self, tables, batch_error):
+        except_log_msg = ("\n\n\n------------------Error---------------------\n\n"
+                          + str(batch_error) + "\n\n")
+        rejected = 0
+        for table in tables:
+            statement = table.statement(self.dialect)
+            for row in table.rows:
+                try:
+                    self.cursor.execute(statement, table.parameters(row))
+                    self.connection.commit()
+                except self.database_errors as e:
+                    self.connection.rollback()
+                    self.metrics.increment("db_row_failures", table=table.table)
+                    except_log_msg += "{0}\n{1};\n-- {2!r}\n".format(e, statement, row)
+                    rejected += 1
+        with open(r"Exceptions.txt", "a", encoding='UTF-8') as my_file:
+            my_file.write(except_log_msg)
+        return rejected
+
+    def _connect(self, connection_string):
+        if connection_string.startswith("sqlite:"):
+            sqlite3.register_adapter(Decimal, str)
+            self.database_errors = (sqlite3.Error,)
+            return sqlite3.connect(connection_string[len("sqlite:"):], check_same_thread=False)
+        # pypyodbc is only imported for ODBC targets
+        self.database_errors = (pyodbc.Error, sqlite3.Error)
+        return pyodbc.connect(connection_string, autocommit=False)
+
+
+class AsyncDbSaver(StorageHandler):
+    """A DbSaver target written by its own writer threads, so a slow or unreachable database holds up neither the
+    crawl nor the other targets.
+
+    commit() appends the buffered rows to this target's journal, queues them for one of writers threads, each with
+    its own connection, and returns straight away; once everything journalled has been written the journal is
+    emptied. When max_pending commits are already queued, or a write fails even after DbSaver has reconnected, the
+    target falls back to the journal alone: commits only go to the journal, and the writers replay it once the
+    queue has drained and retry_interval seconds have passed since the last failure. Writes are idempotent, so
+    replaying a journal is always safe, and journals left behind by a process that died are replayed by the next
+    AsyncDbSaver for the same target; each saver holds a lock on its own journal's lock file for as long as its
+    process runs, which is how the next one tells a dead process's journal from a live one's. Rows the database
+    rejects would only be rejected again, so the commits holding them move to a separate rejected journal that is
+    kept until retry_rejected(), or the replay command, writes them. finish() waits up to finish_timeout seconds for
+    the writers to catch up, leaves anything unwritten in the journal and stops the writers; the next commit()
+    starts them again.
+    """
+    _journal_counter = Counter()
+
+    def __init__(self, game_week, connection_string, season=1415, writers=2, max_pending=20,
+                 journal_directory="journal", retry_interval=30, finish_timeout=600, metrics=None, **db_options):
+        super(AsyncDbSaver, self).__init__(game_week, season, metrics)
+        self.connection_string = connection_string
+        self.writers = writers
+        self.max_pending = max_pending
+        self.retry_interval = retry_interval
+        self.finish_timeout = finish_timeout
+        self.db_options = db_options
+        os.makedirs(journal_directory, exist_ok=True)
+        target = hashlib.sha1(connection_string.encode('UTF-8')).hexdigest()[:16]
+        self._journal_counter[target] += 1
+        stem = os.path.join(journal_directory, "{0}-{1}-{2}".format(target, os.getpid(), self._journal_counter[target]))
+        self.journal_filename = stem + ".jsonl"
+        self.rejected_filename = stem + ".rejected.jsonl"
+        self._journal_lock = open(stem + ".lock", "a+b")
+        _try_lock(self._journal_lock)
+        self._queue = Queue(maxsize=max_pending)
+        self._lock = threading.Condition()
+        self._in_flight = 0
+        self._replaying = False
+        self._failing_until = 0
+        self._journal_only = self._adopt_journals(journal_directory, target)
+        self._stopping = threading.Event()
+        self._threads = []
+        self._start_writers()
+
+    def commit(self):
+        tables = self._buffered_tables()
+        if not tables:
+            return
+        batch = []
+        for table in tables:
+            copy = TableBuffer(table.table, table.columns, table.mode, table.keys)
+            copy.rows, table.rows = table.rows, []
+            batch.append(copy)
+        with self._lock:
+            if not self._threads:
+                self._start_writers()
+            _append_journal(self.journal_filename, batch)
+            if not self._journal_only:
+                try:
+                    self._queue.put_nowait(batch)
+                    self._in_flight += 1
+                    return
+                except Full:
+                    self._journal_only = True
+            self.metrics.increment("journal_spills", target=self.dialect_name)
+
+    def finish(self):
+        """Commits what is buffered, waits for the writers and stops them until the next commit. Returns False if
+        rows were left in the journal or were rejected."""
+        self.commit()
+        deadline = monotonic() + self.finish_timeout
+        with self._lock:
+            if not self._threads and (self._in_flight or self._journal_only):
+                self._start_writers()
+            while (self._in_flight or self._journal_only) and monotonic() < deadline:
+                self._lock.wait(min(1, max(0, deadline - monotonic())))
+            caught_up = not (self._in_flight or self._journal_only)
+        self._stopping.set()
+        for thread in self._threads:
+            thread.join()
+        with self._lock:
+            self._threads = []
+            self._stopping = threading.Event()
+        if not caught_up:
+            print("Rows not yet written to {0} are kept in {1}.".format(self.dialect_name, self.journal_filename))
+        if os.path.exists(self.rejected_filename):
+            print("Commits with rows {0} rejected are kept in {1}.".format(self.dialect_name, self.rejected_filename))
+            return False
+        return caught_up
+
+    def retry_rejected(self):
+        """Moves the rejected journal back into the journal for the writers to write again, returning whether there
+        was one."""
+        with self._lock:
+            if not os.path.exists(self.rejected_filename):
+                return False
+            with open(self.rejected_filename, 'r', encoding='UTF-8') as rejected, \
+                    open(self.journal_filename, 'a', encoding='UTF-8') as journal:
+                journal.write(rejected.read())
+            os.remove(self.rejected_filename)
+            self._journal_only = True
+            self._failing_until = 0
+            return True
+
+    @property
+    def dialect_name(self):
+        return type(dialect_for(self.connection_string)).__name__[:-len("Dialect")]
+
+    def _adopt_journals(self, journal_directory, target):
+        """Takes over the journals of earlier processes for this target, returning whether there was any to
+        replay."""
+        adopted = False
+        own_stem = os.path.basename(self.journal_filename)[:-len(".jsonl")]
+        stems = set(match.group(1) for match in (re.match(r'^({0}-[0-9]+-[0-9]+)\.'.format(target), filename)
+                                                 for filename in os.listdir(journal_directory)) if match)
+        for stem in sorted(stems - {own_stem}):
+            path = os.path.join(journal_directory, stem)
+            with open(path + ".lock", "a+b") as lock_file:
+                if not _try_lock(lock_file):
+                    # its saver is still running
+                    continue
+                for suffix, filename in ((".jsonl", self.journal_filename),
+                                         (".jsonl.replaying", self.journal_filename),
+                                         (".rejected.jsonl", self.rejected_filename)):
+                    if os.path.exists(path + suffix):
+                        with open(path + suffix, 'r', encoding='UTF-8') as old_journal, \
+                                open(filename, 'a', encoding='UTF-8') as journal:
+                            journal.write(old_journal.read())
+                        os.remove(path + suffix)
+                        adopted = adopted or filename == self.journal_filename
+            os.remove(path + ".lock")
+        return adopted
+
+    def _start_writers(self):
+        self._threads = [threading.Thread(target=self._write_loop, args=(self._stopping,), daemon=True)
+                         for _ in range(self.writers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _write_loop(self, stopping):
+        saver = None
+        while not stopping.is_set():
+            try:
+                batch = self._queue.get(timeout=0.5)
+            except Empty:
+                batch = None
+            try:
+                if batch is None and not self._start_replay():
+                    continue
+                if saver is None:
+                    saver = DbSaver(self.game_week, self.connection_string, self.season, metrics=self.metrics,
+                                    **self.db_options)
+                if batch is None:
+                    self._replay(saver)
+                else:
+                    if saver.write(batch):
+                        self._reject(batch)
+                    self._written()
+            except Exception as error:
+                print("Writing to {0} failed: {1!r}".format(self.dialect_name, error))
+                self.metrics.increment("async_write_failures", target=self.dialect_name)
+                if saver is not None:
+                    saver.close()
+                    saver = None
+                self._failed(batch is not None)
+        if saver is not None:
+            saver.close()
+
+    def _start_replay(self):
+        with self._lock:
+            if (not self._journal_only or self._replaying or self._in_flight
+                    or monotonic() < self._failing_until):
+                return False
+            self._replaying = True
+            return True
+
+    def _replay(self, saver):
+        replaying = self.journal_filename + ".replaying"
+        try:
+            with self._lock:
+                if not os.path.exists(replaying) and os.path.exists(self.journal_filename):
+                    os.replace(self.journal_filename, replaying)
+            if os.path.exists(replaying):
+                for batch in _read_journal(replaying):
+                    if saver.write(batch):
+                        self._reject(batch)
+                os.remove(replaying)
+                self.metrics.increment("journal_replays", target=self.dialect_name)
+        finally:
+            with self._lock:
+                self._replaying = False
+                if not os.path.exists(replaying) and not os.path.exists(self.journal_filename):
+                    self._journal_only = False
+                self._lock.notify_all()
+
+    def _reject(self, batch):
+        self.metrics.increment("journal_rejections", target=self.dialect_name)
+        with self._lock:
+            _append_journal(self.rejected_filename, batch)
+
+    def _written(self):
+        with self._lock:
+            self._in_flight -= 1
+            if not self._in_flight and not self._journal_only and os.path.exists(self.journal_filename):
+                os.remove(self.journal_filename)
+            self._lock.notify_all()
+
+    def _failed(self, batch_failed):
+        with self._lock:
+            if batch_failed:
+                self._in_flight -= 1
+            self._journal_only = True
+            self._failing_until = monotonic() + self.retry_interval
+            self._lock.notify_all()
+
+
+def _read_journal(filename):
+    with open(filename, 'r', encoding='UTF-8') as journal:
+        for line in journal:
+            try:
+                tables = json.loads(line)
+            except ValueError:
+                # a commit cut short when its process died was never acknowledged, so it is dropped
+                continue
+            batch = []
+            for table, columns, mode, keys, rows in tables:
+                buffer = TableBuffer(table, columns, mode, keys)
+                buffer.rows = rows
+                batch.append(buffer)
+            yield batch
+
+
+def _append_journal(filename, batch):
+    line = json.dumps([[table.table, table.columns, table.mode, table.keys, table.rows] for table in batch],
+                      default=str)
+    with open(filename, "a", encoding='UTF-8') as journal:
+        journal.write(line + "\n")
+
+
+def _try_lock(lock_file):
+    """Takes an exclusive lock on an open file without waiting, returning whether it was free. The lock is held
+    until the file is closed or its process exits, however the process ends."""
+    try:
+        if msvcrt is not None:
+            lock_file.seek(0)
+            msvcrt.locking(lock_file.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+class ParquetSaver(StorageHandler):
+    """Writes the same tables as DbSaver to compressed parquet files instead of a database.
+
+    Files are hive partitioned as directory/<table>/season=<season>/game_week=<game_week>/part-*.parquet, so season
+    and game_week live in the path rather than in the files. Committed rows collect until there are row_group_size
+    of them and are then written as one row group, which keeps memory bounded on long crawls. finish() flushes what
+    is left and closes the files; anything written afterwards goes to new part files. A parquet file can only be
+    read once it is closed, so with close_on_commit every commit() writes and closes its own part files instead,
+    which is what a crawl with a JobLedger needs before it marks a page committed.
+    """
+    PARTITION_COLUMNS = ("season", "game_week")
+    STRING_COLUMNS = frozenset(["name", "club", "team_name", "country", "gameWeekTeamID", "web_name", "type_name",
+                                "news", "first_name", "second_name"])
+    FLOAT_COLUMNS = PLAYER_DECIMAL_COLUMNS | frozenset(["worth", "bank"])
+
+    def __init__(self, game_week, directory, season=1415, row_group_size=50000, compression="zstd", metrics=None,
+                 close_on_commit=False):
+        if pyarrow is None:
+            raise ImportError("ParquetSaver needs pyarrow")
+        super(ParquetSaver, self).__init__(int(game_week), season, metrics)
+        self.directory = directory
+        self.row_group_size = row_group_size
+        self.compression = compression
+        self.close_on_commit = close_on_commit
+        self._pending = {}
+        self._writers = {}
+
+    def commit(self):
+        for table in self._buffered_tables():
+            columns = self._file_columns(table)
+            positions = [table.columns.index(column) if column in table.columns else None for column in columns]
+            pending = self._pending.setdefault(table.table, [])
+            pending.extend(tuple(row[i] if i is not None else None for i in positions) for row in table.rows)
+            table.rows = []
+            if len(pending) >= self.row_group_size:
+                self._write_row_group(table.table)
+        if self.close_on_commit:
+            self._close_files()
+
+    def finish(self):
+        self.commit()
+        self._close_files()
+
+    def _close_files(self):
+        for name in list(self._pending):
+            self._write_row_group(name)
+        for writer, part_file in self._writers.values():
+            writer.close()
+            part_file.close()
+        self._writers = {}
+
+    def _file_columns(self, table):
+        columns = PLAYER_COLUMNS if table.table == "Player" else table.columns
+        return [column for column in columns if column not in self.PARTITION_COLUMNS]
+
+    def _column_type(self, column):
+        if column in self.STRING_COLUMNS:
+            return pyarrow.string()
+        if column in self.FLOAT_COLUMNS:
+            return pyarrow.float64()
+        return pyarrow.int64()
+
+    def _write_row_group(self, name):
+        rows = self._pending.pop(name, None)
+        if not rows:
+            return
+        columns = self._file_columns(self.tables[name])
+        schema = pyarrow.schema([(column, self._column_type(column)) for column in columns])
+        arrays = []
+        for column, values in zip(columns, zip(*rows)):
+            if column in self.STRING_COLUMNS:
+                # the row builders store missing values as 0, which has no place in a string column
+                values = [value if isinstance(value, str) else None for value in values]
+            elif column in self.FLOAT_COLUMNS:
+                values = [None if value is None else float(value) for value in values]
+            else:
+                values = [None if value is None else int(value) for value in values]
+            arrays.append(pyarrow.array(values, type=self._column_type(column)))
+        writer, _ = self._writers.get(name, (None, None))
+        if writer is None:
+            partition = os.path.join(self.directory, name, "season={0}".format(self.season),
+                                     "game_week={0}".format(self.game_week))
+            os.makedirs(partition, exist_ok=True)
+            # a new part file per commit with close_on_commit, so names must never repeat, even within a millisecond
+            part_file = open(os.path.join(partition, "part-{0}.parquet".format(uuid.uuid4().hex)), "xb")
+            writer = pyarrow.parquet.ParquetWriter(part_file, schema, compression=self.compression)
+            self._writers[name] = (writer, part_file)
+        with self.metrics.timer("parquet_write_seconds"):
+            writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema), row_group_size=len(rows))
+        self.metrics.increment("parquet_rows", len(rows), table=name)
+
+
+StoredSquad = namedtuple('StoredSquad', ['game_week', 'player_ids', 'positions', 'captain_index',
+                                         'vice_captain_index', 'club', 'country', 'squad_game_week'])
+
+
+def _split_ids(text):
+    return tuple(int(value) for value in text.split(",") if value) if text else ()
+
+
+class JobLedger(object):
+    """Remembers which standings pages, and which managers on them, every storage handler has committed.
+
+    Keyed by (season, game_week, league_id, page) in a small sqlite file, with a single write per committed page,
+    so a crawl that dies part way can be restarted without redoing finished pages. The same write keeps the last
+    squad seen for every manager on the page, which incremental crawls fingerprint the next gameweek against.
+    """
+    def __init__(self, filename="crawl_ledger.db"):
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS page_ledger (season int, game_week int, "
+                                    "league_id int, page int, manager_ids text, committed_at real, "
+                                    "PRIMARY KEY (season, game_week, league_id, page))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS player_snapshot (season int, id int, digest text, "
+                                    "PRIMARY KEY (season, id))")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS squad (season int, manager_id text, game_week int, "
+                                    "player_ids text, positions text, captain_index int, vice_captain_index int, "
+                                    "club text, country text, transfers_in text, squad_game_week int, "
+                                    "PRIMARY KEY (season, manager_id))")
+            if "squad_game_week" not in [column[1] for column in
+                                         self.connection.execute("PRAGMA table_info(squad)")]:
+                self.connection.execute("ALTER TABLE squad ADD COLUMN squad_game_week int")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS crawl_run (season int, game_week int, league_id int, "
+                                    "starting_rank int, finishing_rank int, started_at real)")
+            self.connection.commit()
+
+    def committed_pages(self, season, game_week, league_id):
+        with self._lock:
+            rows = self.connection.execute("SELECT page FROM page_ledger WHERE season = ? AND game_week = ? "
+                                           "AND league_id = ?", (season, game_week, league_id)).fetchall()
+        return set(page for page, in rows)
+
+    def committed_managers(self, season, game_week, league_id):
+        with self._lock:
+            rows = self.connection.execute("SELECT manager_ids FROM page_ledger WHERE season = ? AND game_week = ? "
+                                           "AND league_id = ?", (season, game_week, league_id)).fetchall()
+        return set(manager_id for manager_ids, in rows for manager_id in manager_ids.split(",") if manager_id)
+
+    def record_run(self, season, game_week, league_id, starting_rank, finishing_rank):
+        with self._lock:
+            self.connection.execute("INSERT INTO crawl_run VALUES (?, ?, ?, ?, ?, ?)",
+                                    (season, game_week, league_id, starting_rank, finishing_rank, time()))
+            self.connection.commit()
+
+    def last_run(self):
+        """(season, game_week, league_id, starting_rank, finishing_rank) of the latest manager crawl, or None."""
+        with self._lock:
+            return self.connection.execute("SELECT season, game_week, league_id, starting_rank, finishing_rank "
+                                           "FROM crawl_run ORDER BY started_at DESC LIMIT 1").fetchone()
+
+    def summary(self):
+        with self._lock:
+            rows = self.connection.execute("SELECT season, game_week, league_id, COUNT(*), "
+                                           "SUM(LENGTH(manager_ids) > 0) + SUM(LENGTH(manager_ids) - "
+                                           "LENGTH(REPLACE(manager_ids, ',', ''))), MAX(committed_at) "
+                                           "FROM page_ledger GROUP BY season, game_week, league_id "
+                                           "ORDER BY season, game_week, league_id").fetchall()
+        return [{"season": season, "game_week": game_week, "league_id": league_id, "pages": pages,
+                 "managers": managers, "last_committed_at": last_committed_at}
+                for season, game_week, league_id, pages, managers, last_committed_at in rows]
+
+    def mark_page_committed(self, season, game_week, league_id, page, manager_ids, squads=()):
+        """Records the page and the (manager_id, EntryRecord) squads on it, returning how many players were
+        transferred in since each manager's stored squad."""
+        with self._lock:
+            transfers = self._save_squads(season, game_week, squads) if squads else 0
+            self.connection.execute("INSERT OR REPLACE INTO page_ledger VALUES (?, ?, ?, ?, ?, ?)",
+                                    (season, game_week, league_id, page, ",".join(str(i) for i in manager_ids),
+                                     time()))
+            self.connection.commit()
+        return transfers
+
+    def squads(self, season, manager_ids):
+        manager_ids = [str(manager_id) for manager_id in manager_ids]
+        if not manager_ids:
+            return {}
+        with self._lock:
+            rows = self.connection.execute("SELECT manager_id, game_week, player_ids, positions, captain_index, "
+                                           "vice_captain_index, club, country, squad_game_week FROM squad "
+                                           "WHERE season = ? AND manager_id IN ({0})".format(
+                                               ", ".join("?" * len(manager_ids))),
+                                           [season] + manager_ids).fetchall()
+        return dict((manager_id, StoredSquad(game_week, _split_ids(player_ids), _split_ids(positions), captain_index,
+                                             vice_captain_index, club, country,
+                                             squad_game_week if squad_game_week is not None else game_week))
+                    for manager_id, game_week, player_ids, positions, captain_index, vice_captain_index, club, country,
+                    squad_game_week in rows)
+
+    def player_digests(self, season):
+        with self._lock:
+            rows = self.connection.execute("SELECT id, digest FROM player_snapshot WHERE season = ?",
+                                           (season,)).fetchall()
+        return dict(rows)
+
+    def save_player_digests(self, season, digests):
+        with self._lock:
+            self.connection.executemany("INSERT OR REPLACE INTO player_snapshot VALUES (?, ?, ?)",
+                                        [(season, player_id, digest) for player_id, digest in digests.items()])
+            self.connection.commit()
+
+    def _save_squads(self, season, game_week, squads):
+        manager_ids = [str(manager_id) for manager_id, _ in squads]
+        stored = dict((manager_id, (stored_game_week, player_ids, transfers_in)) for
+                      manager_id, stored_game_week, player_ids, transfers_in in self.connection.execute(
+                          "SELECT manager_id, game_week, player_ids, transfers_in FROM squad WHERE season = ? AND "
+                          "manager_id IN ({0})".format(", ".join("?" * len(manager_ids))), [season] + manager_ids))
+        rows = []
+        transfers = 0
+        for manager_id, record in squads:
+            manager_id = str(manager_id)
+            player_ids = ",".join(str(player_id) for player_id in record.player_ids)
+            transfers_in = ""
+            if manager_id in stored:
+                stored_game_week, stored_player_ids, transfers_in = stored[manager_id]
+                if stored_game_week != game_week:
+                    kept = set(_split_ids(stored_player_ids))
+                    transfers_in = ",".join(str(player_id) for player_id in record.player_ids if player_id not in kept)
+                transfers += len(_split_ids(transfers_in))
+            rows.append((season, manager_id, game_week, player_ids,
+                         ",".join(str(position) for position in record.positions), record.captain_index,
+                         record.vice_captain_index, record.club, record.country, transfers_in,
+                         record.squad_game_week if record.squad_game_week is not None else game_week))
+        self.connection.executemany("INSERT OR REPLACE INTO squad VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        return transfers
+
+
+class CrawlPipeline(object):
+    """Overlaps fetching, parsing and writing of a manager crawl.
+
+    A dispatcher thread fetches standings pages and submits their entry pages to a pool of controller.concurrency
+    fetch workers, apart from managers an incremental crawl carries forward. A parse thread hands each entry page to
+    parse_entry, in a process pool of parse_processes workers when that is non zero. The calling thread turns records
+    into managers and teams in rank order and fans them out to one writer thread per storage handler, each of which
+    commits once per standings page. Every stage hands over through a queue of at most queue_size items, so a slow
+    database stalls fetching instead of filling memory.
+
+    If a stage fails, or the crawl is interrupted, no new pages are started but everything already fetched is
+    parsed, written and committed before the error is raised. A page that lost a manager on the way, or had rows
+    rejected by a database, is not marked committed in the ledger, so resuming crawls it again.
+    """
+    PAGES_AHEAD = 2
+    _DONE = object()
+
+    def __init__(self, controller, parse_processes=0, queue_size=500):
+        self.controller = controller
+        self.parse_processes = parse_processes
+        self.fetched = Queue(queue_size)
+        self.parsed = Queue(queue_size)
+        self.handler_queues = [Queue(queue_size) for _ in controller.storage_handlers]
+        self.stopping = threading.Event()
+        self.errors = []
+        self._page_commits = Counter()
+        self._failed_pages = set()
+        self._page_lock = threading.Lock()
+
+    def run(self, pages):
+        controller = self.controller
+        fetch_pool = ThreadPoolExecutor(max_workers=controller.concurrency)
+        parse_pool = None
+        if self.parse_processes:
+            parse_pool = concurrent.futures.ProcessPoolExecutor(max_workers=self.parse_processes)
+        threads = [threading.Thread(target=self._fetch_stage, args=(pages, fetch_pool)),
+                   threading.Thread(target=self._parse_stage, args=(parse_pool,))]
+        threads += [threading.Thread(target=self._write_stage, args=(handler, handler_queue))
+                    for handler, handler_queue in zip(controller.storage_handlers, self.handler_queues)]
+        for thread in threads:
+            thread.start()
+        try:
+            self._persist_stage()
+        except BaseException as error:
+            self.shutdown(error)
+            self._persist_stage()
+        finally:
+            for handler_queue in self.handler_queues:
+                handler_queue.put(self._DONE)
+            for thread in threads:
+                thread.join()
+            fetch_pool.shutdown()
+            if parse_pool:
+                parse_pool.shutdown()
+        if self.errors:
+            raise self.errors[0]
+
+    def shutdown(self, error=None):
+        if error is not None:
+            self.errors.append(error)
+        self.stopping.set()
+
+    def _fetch_stage(self, pages, fetch_pool):
+        controller = self.controller
+        pages = iter(pages)
+        standings = deque()
+        try:
+            for page in islice(pages, self.PAGES_AHEAD):
+                standings.append((page, fetch_pool.submit(controller._fetch, controller._standings_url(page))))
+            while standings and not self.stopping.is_set():
+                page, standings_future = standings.popleft()
+                for next_page in islice(pages, 1):
+                    standings.append((next_page, fetch_pool.submit(controller._fetch,
+                                                                   controller._standings_url(next_page))))
+                rows = controller._scrape_standings_rows(standings_future.result())
+                links = controller._pending_links([row.link for row in rows])
+                carried = controller._carried_records(rows, links)
+                for link in links:
+                    if link in carried:
+                        self.fetched.put((page, link, carried[link]))
+                    else:
+                        self.fetched.put((page, link, fetch_pool.submit(controller._fetch,
+                                                                        controller._entry_url(link))))
+                self.fetched.put((page, None, None))
+        except Exception as error:
+            self.shutdown(error)
+        finally:
+            for _, standings_future in standings:
+                standings_future.cancel()
+            self.fetched.put(self._DONE)
+
+    def _parse_stage(self, parse_pool):
+        while True:
+            item = self.fetched.get()
+            if item is self._DONE:
+                self.parsed.put(self._DONE)
+                return
+            page, link, entry_future = item
+            if link is None or isinstance(entry_future, EntryRecord):
+                self.parsed.put(item)
+                continue
+            try:
+                entry_html = entry_future.result()
+                if parse_pool:
+                    self.parsed.put((page, link, parse_pool.submit(timed_parse_entry, entry_html)))
+                else:
+                    with self.controller.metrics.timer("entry_parse_seconds"):
+                        record = parse_entry(entry_html)
+                    self.parsed.put((page, link, record))
+            except Exception as error:
+                self._page_failed(page)
+                self.shutdown(error)
+
+    def _persist_stage(self):
+        entries = []
+        while True:
+            item = self.parsed.get()
+            if item is self._DONE:
+                return
+            page, link, record = item
+            if link is None:
+                self._to_writers((page, None, entries))
+                entries = []
+                continue
+            try:
+                if isinstance(record, Future):
+                    record, parse_seconds = record.result()
+                    self.controller.metrics.observe("entry_parse_seconds", parse_seconds)
+                man, team = self.controller._create_manager_and_team(link, record)
+                self._to_writers((page, man, team))
+                entries.append((man.id, record))
+            except Exception as error:
+                self._page_failed(page)
+                self.shutdown(error)
+
+    def _to_writers(self, item):
+        for handler_queue in self.handler_queues:
+            handler_queue.put(item)
+
+    def _write_stage(self, handler, handler_queue):
+        while True:
+            item = handler_queue.get()
+            if item is self._DONE:
+                break
+            page, man, team = item
+            try:
+                if man is None:
+                    if handler.commit():
+                        self._page_failed(page)
+                    self._page_committed(page, team)
+                    continue
+                handler.add_entry(man, team)
+            except Exception as error:
+                self._page_failed(page)
+                self.shutdown(error)
+        try:
+            handler.commit()
+        except Exception as error:
+            self.shutdown(error)
+
+    def _page_committed(self, page, entries):
+        with self._page_lock:
+            self._page_commits[page] += 1
+            if self._page_commits[page] < len(self.handler_queues):
+                return
+            del self._page_commits[page]
+            if page in self._failed_pages:
+                print("Page {0} is incomplete and was not marked committed.".format(page))
+                return
+        self.controller._mark_page_committed(page, entries)
+        print("Page {0} added.".format(page))
+
+    def _page_failed(self, page):
+        with self._page_lock:
+            self._failed_pages.add(page)
+
+
+class EliteAnalytics(object):
+    """In-memory versions of the reports in sql files/data filters.sql, for every gameweek at once.
+
+    Player ids are coded to 0..n-1 and all the ownership, starts and captaincy counts are built by one bincount per
+    measure over every gameweek in the data, giving (gameweek x player) matrices. The reports are then slices and
+    sorts of those matrices rather than a join and GROUP BY per gameweek.
+    """
+    PLAYER_COLUMNS = ("id", "web_name", "selected_by_percent", "now_cost", "total_points", "minutes",
+                      "points_per_game", "transfers_in", "transfers_out", "element_type", "event_total")
+
+    def __init__(self, team_game_weeks, captain_ids, vice_captain_ids, position_game_weeks, position_ids,
+                 position_started, players):
+        if numpy is None:
+            raise ImportError("EliteAnalytics needs numpy")
+        team_game_weeks = numpy.asarray(team_game_weeks, dtype=numpy.int64)
+        position_game_weeks = numpy.asarray(position_game_weeks, dtype=numpy.int64)
+        position_ids = numpy.asarray(position_ids, dtype=numpy.int64)
+        captain_ids = numpy.asarray(captain_ids, dtype=numpy.int64)
+        vice_captain_ids = numpy.asarray(vice_captain_ids, dtype=numpy.int64)
+        stored_ids = numpy.asarray(players["id"], dtype=numpy.int64)
+
+        self.player_ids = numpy.unique(numpy.concatenate([stored_ids, position_ids, captain_ids, vice_captain_ids]))
+        self.game_weeks = numpy.unique(numpy.concatenate([team_game_weeks, position_game_weeks]))
+        player_count, week_count = len(self.player_ids), len(self.game_weeks)
+
+        self.players = {}
+        stored = numpy.searchsorted(self.player_ids, stored_ids)
+        for column in self.PLAYER_COLUMNS[1:]:
+            if column == "web_name":
+                values = numpy.full(player_count, "", dtype=object)
+                values[stored] = players[column]
+            else:
+                values = numpy.full(player_count, numpy.nan)
+                values[stored] = numpy.asarray(players[column], dtype=float)
+            self.players[column] = values
+
+        def counts(game_weeks, player_ids, weights=None):
+            cells = (numpy.searchsorted(self.game_weeks, game_weeks) * player_count
+                     + numpy.searchsorted(self.player_ids, player_ids))
+            return numpy.bincount(cells, weights, minlength=week_count * player_count).reshape(week_count,
+                                                                                              player_count)
+
+        self.teams_per_week = numpy.bincount(numpy.searchsorted(self.game_weeks, team_game_weeks),
+                                             minlength=week_count)
+        self.ownership = counts(position_game_weeks, position_ids)
+        self.starts = counts(position_game_weeks, position_ids, numpy.asarray(position_started, dtype=float))
+        self.captaincy = counts(team_game_weeks, captain_ids)
+        self.vice_captaincy = counts(team_game_weeks, vice_captain_ids)
+
+    @classmethod
+    def from_connection(cls, connection):
+        """Loads the crawled tables through any DB-API connection, e.g. DbSaver.connection."""
+        cursor = connection.cursor()
+        teams = cursor.execute("SELECT game_week, captainID, vice_captainID FROM GameWeekTeam").fetchall()
+        # a carried squad's Position rows belong to the GameWeekTeam row of the gameweek it was carried from
+        positions = cursor.execute("SELECT GameWeekTeam.game_week, Position.id, Position.started FROM GameWeekTeam "
+                                   "JOIN GameWeekTeam squad ON squad.managerID = GameWeekTeam.managerID "
+                                   "AND squad.season = GameWeekTeam.season AND squad.game_week = "
+                                   "COALESCE(GameWeekTeam.squad_game_week, GameWeekTeam.game_week) "
+                                   "JOIN Position ON Position.gameWeekTeamID = squad.gameWeekTeamID").fetchall()
+        player_rows = cursor.execute("SELECT {0} FROM Player".format(", ".join(cls.PLAYER_COLUMNS))).fetchall()
+        players = dict(zip(cls.PLAYER_COLUMNS, [list(column) for column in zip(*player_rows)] if player_rows
+                           else [[] for _ in cls.PLAYER_COLUMNS]))
+        players = dict((column, [0 if value is None and column != "web_name" else value for value in values])
+                       for column, values in players.items())
+        team_columns = list(zip(*teams)) or [(), (), ()]
+        position_columns = list(zip(*positions)) or [(), (), ()]
+        return cls(team_columns[0], team_columns[1], team_columns[2], position_columns[0], position_columns[1],
+                   position_columns[2], players)
+
+    @classmethod
+    def from_parquet(cls, directory):
+        """Loads the partitioned files ParquetSaver writes."""
+        import pyarrow.dataset
+
+        def read(table, columns):
+            data = pyarrow.dataset.dataset(os.path.join(directory, table), partitioning="hive")
+            return data.to_table(columns=columns).to_pydict()
+
+        teams = read("GameWeekTeam", ["game_week", "captainID", "vice_captainID", "managerID", "squad_game_week"])
+        squads = defaultdict(dict)
+        stored = read("Position", ["gameWeekTeamID", "id", "started"])
+        for game_week_team_id, player_id, started in zip(stored["gameWeekTeamID"], stored["id"], stored["started"]):
+            squads[game_week_team_id][player_id] = started
+        # a carried squad's Position rows are stored under the gameweek it was carried from
+        positions = {"game_week": [], "id": [], "started": []}
+        for game_week, manager_id, squad_game_week in zip(teams["game_week"], teams["managerID"],
+                                                          teams["squad_game_week"]):
+            squad_game_week = squad_game_week if squad_game_week is not None else game_week
+            for player_id, started in squads.get("{0}-{1}".format(manager_id, squad_game_week), {}).items():
+                positions["game_week"].append(game_week)
+                positions["id"].append(player_id)
+                positions["started"].append(started)
+        players = read("Player", list(cls.PLAYER_COLUMNS) + ["game_week"])
+        # every gameweek has its own Player partition; keep each player's row from the latest one
+        ids = numpy.asarray(players["id"], dtype=numpy.int64)
+        order = numpy.lexsort((numpy.asarray(players.pop("game_week"), dtype=numpy.int64), ids))
+        latest = order[numpy.append(ids[order][1:] != ids[order][:-1], True)] if len(order) else order
+        players = dict((column, [values[i] for i in latest]) for column, values in players.items())
+        return cls(teams["game_week"], teams["captainID"], teams["vice_captainID"], positions["game_week"],
+                   positions["id"], positions["started"], players)
+
+    def elite_utilization(self, game_week, element_type=None, started_only=False, top=None):
+        """Share of elite squads holding each player against selected_by_percent, as in the first data filter."""
+        week = self._week_index(game_week)
+        counts = (self.starts if started_only else self.ownership)[week]
+        selected = counts > 0
+        if element_type is not None:
+            selected &= self.players["element_type"] == element_type
+        indexes = numpy.flatnonzero(selected)
+        utilization = counts[indexes] / max(self.teams_per_week[week], 1) * 100
+        order = numpy.lexsort((-numpy.nan_to_num(self.players["now_cost"][indexes]), -utilization))[:top]
+        minutes, total_points = self.players["minutes"], self.players["total_points"]
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            minutes_per_point = minutes / total_points
+        return [{"id": int(self.player_ids[i]), "web_name": self.players["web_name"][i],
+                 "elite_util": float(utilization[rank]), "count": int(counts[i]),
+                 "selected_by_percent": float(self.players["selected_by_percent"][i]),
+                 "now_cost": float(self.players["now_cost"][i]), "total_points": float(total_points[i]),
+                 "game_week": int(self.game_weeks[week]), "min_per_point": float(minutes_per_point[i]),
+                 "points_per_game": float(self.players["points_per_game"][i]),
+                 "net_xfer": float(self.players["transfers_in"][i] - self.players["transfers_out"][i])}
+                for rank, i in ((rank, indexes[rank]) for rank in order)]
+
+    def utilization_deltas(self, top=None):
+        """Week over week change in elite utilization for every player, keyed by the later gameweek."""
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            utilization = self.ownership / numpy.maximum(self.teams_per_week, 1)[:, numpy.newaxis] * 100
+        deltas = numpy.diff(utilization, axis=0)
+        report = {}
+        for week in range(1, len(self.game_weeks)):
+            order = numpy.argsort(-numpy.abs(deltas[week - 1]), kind="stable")[:top]
+            report[int(self.game_weeks[week])] = [
+                {"id": int(self.player_ids[i]), "web_name": self.players["web_name"][i],
+                 "elite_util": float(utilization[week, i]), "delta": float(deltas[week - 1, i])}
+                for i in order if deltas[week - 1, i]]
+        return report
+
+    def most_captained(self, game_week, top=None):
+        return self._ranked(self.captaincy[self._week_index(game_week)], "captained", top)
+
+    def most_vice_captained(self, game_week, top=None):
+        return self._ranked(self.vice_captaincy[self._week_index(game_week)], "vice_captained", top)
+
+    def average_cost(self, element_type=None):
+        """Average now_cost, in millions, over every elite squad slot."""
+        owned = self.ownership.sum(axis=0)
+        selected = (owned > 0) & ~numpy.isnan(self.players["now_cost"])
+        if element_type is not None:
+            selected &= self.players["element_type"] == element_type
+        if not owned[selected].sum():
+            return None
+        return float(numpy.average(self.players["now_cost"][selected], weights=owned[selected]) / 10)
+
+    def minutes_per_point(self, min_minutes=500, element_type=None):
+        minutes, total_points = self.players["minutes"], self.players["total_points"]
+        selected = (minutes > min_minutes) & (self.players["event_total"] > 0) & (total_points > 0)
+        if element_type is not None:
+            selected &= self.players["element_type"] == element_type
+        indexes = numpy.flatnonzero(selected)
+        minutes_per_point = minutes[indexes] / total_points[indexes]
+        return [{"id": int(self.player_ids[i]), "web_name": self.players["web_name"][i],
+                 "min_per_point": float(value), "points_per_game": float(self.players["points_per_game"][i]),
+                 "net_xfer": float(self.players["transfers_in"][i] - self.players["transfers_out"][i])}
+                for value, i in sorted(zip(minutes_per_point, indexes))]
+
+    def _ranked(self, counts, name, top):
+        indexes = numpy.flatnonzero(counts)
+        order = indexes[numpy.argsort(-counts[indexes], kind="stable")][:top]
+        return [{name: int(counts[i]), "id": int(self.player_ids[i]), "web_name": self.players["web_name"][i]}
+                for i in order]
+
+    def _week_index(self, game_week):
+        week = numpy.searchsorted(self.game_weeks, int(game_week))
+        if week >= len(self.game_weeks) or self.game_weeks[week] != int(game_week):
+            raise KeyError("no data for gameweek {0}".format(game_week))
+        return week
+
+
+class RankStore(object):
+    """An append-only columnar store of league standings: manager id, rank, gameweek points and total points for
+    every manager crawled, per season, league and gameweek.
+
+    Each column is a flat file of 4 byte integers in directory/<season>/<league_id>/<game_week>/, and a standings
+    page is stored by appending its rows to the four files, so storing costs four small writes and loading a
+    gameweek four reads. A crash between appends can leave one column longer than the others, so reads cut every
+    column to the shortest; a page stored twice keeps its last copy.
+    """
+    COLUMNS = (("manager_id", "I"), ("rank", "I"), ("game_week_points", "i"), ("total_points", "i"))
+
+    def __init__(self, directory="ranks"):
+        self.directory = directory
+        self._lock = threading.Lock()
+
+    def append(self, season, league_id, game_week, rows):
+        if not rows:
+            return
+        path = self._path(season, league_id, game_week)
+        link_parser = LinkParser()
+        values = {"manager_id": [int(link_parser.extract_player_id(row.link)) for row in rows],
+                  "rank": [row.rank for row in rows], "game_week_points": [row.game_week_points for row in rows],
+                  "total_points": [row.total_points for row in rows]}
+        with self._lock:
+            os.makedirs(path, exist_ok=True)
+            for column, typecode in self.COLUMNS:
+                with open(os.path.join(path, column), "ab") as column_file:
+                    array(typecode, values[column]).tofile(column_file)
+
+    def read(self, season, league_id, game_week):
+        """The columns stored for a gameweek as a dict of arrays, empty ones if there are none."""
+        path = self._path(season, league_id, game_week)
+        columns = {}
+        with self._lock:
+            for column, typecode in self.COLUMNS:
+                columns[column] = array(typecode)
+                filename = os.path.join(path, column)
+                if os.path.exists(filename):
+                    with open(filename, "rb") as column_file:
+                        columns[column].frombytes(column_file.read())
+        rows = min(len(values) for values in columns.values())
+        return dict((column, values[:rows]) for column, values in columns.items())
+
+    def max_rank(self, season, league_id, game_week):
+        ranks = self.read(season, league_id, game_week)["rank"]
+        return max(ranks) if ranks else 0
+
+    def game_weeks(self, season, league_id):
+        path = os.path.join(self.directory, str(season), str(league_id))
+        if not os.path.isdir(path):
+            return []
+        return sorted(int(name) for name in os.listdir(path) if name.isdigit())
+
+    def history(self, season, league_id, game_weeks=None):
+        game_weeks = game_weeks or self.game_weeks(season, league_id)
+        return RankHistory(game_weeks, [self.read(season, league_id, game_week) for game_week in game_weeks])
+
+    def _path(self, season, league_id, game_week):
+        return os.path.join(self.directory, str(season), str(league_id), str(int(game_week)))
+
+
+class RankHistory(object):
+    """A league's stored standings in memory as (gameweek x manager) rank and points matrices, for rank movement
+    queries over any pair of gameweeks. A manager missing from a gameweek has rank 0 in it."""
+    def __init__(self, game_weeks, columns):
+        if numpy is None:
+            raise ImportError("RankHistory needs numpy")
+        self.game_weeks = numpy.asarray(sorted(int(game_week) for game_week in game_weeks), dtype=numpy.int64)
+        weeks = []
+        for game_week, week in sorted(zip((int(game_week) for game_week in game_weeks), columns)):
+            manager_ids = numpy.asarray(week["manager_id"], dtype=numpy.int64)
+            # the last copy of a manager's row is the latest
+            manager_ids, last = numpy.unique(manager_ids[::-1], return_index=True)
+            last = len(week["manager_id"]) - 1 - last
+            weeks.append((manager_ids, dict((column, numpy.asarray(week[column], dtype=numpy.int64)[last])
+                                            for column in ("rank", "game_week_points", "total_points"))))
+        self.manager_ids = numpy.unique(numpy.concatenate([manager_ids for manager_ids, _ in weeks] or [[]])
+                                        ).astype(numpy.int64)
+        shape = (len(self.game_weeks), len(self.manager_ids))
+        self.ranks = numpy.zeros(shape, dtype=numpy.int64)
+        self.game_week_points = numpy.zeros(shape, dtype=numpy.int64)
+        self.total_points = numpy.zeros(shape, dtype=numpy.int64)
+        for week, (manager_ids, values) in enumerate(weeks):
+            managers = numpy.searchsorted(self.manager_ids, manager_ids)
+            self.ranks[week, managers] = values["rank"]
+            self.game_week_points[week, managers] = values["game_week_points"]
+            self.total_points[week, managers] = values["total_points"]
+
+    def rank_movement(self, from_game_week, to_game_week, top=50, fallers=False):
+        """The managers ranked in both gameweeks who climbed furthest between them, or fell furthest."""
+        from_week, to_week = self._week_index(from_game_week), self._week_index(to_game_week)
+        managers = numpy.flatnonzero((self.ranks[from_week] > 0) & (self.ranks[to_week] > 0))
+        movement = self.ranks[from_week, managers] - self.ranks[to_week, managers]
+        order = managers[numpy.argsort(movement if fallers else -movement, kind="stable")][:top]
+        return [{"manager_id": int(self.manager_ids[i]), "from_rank": int(self.ranks[from_week, i]),
+                 "to_rank": int(self.ranks[to_week, i]),
+                 "movement": int(self.ranks[from_week, i] - self.ranks[to_week, i]),
+                 "game_week_points": int(self.game_week_points[to_week, i]),
+                 "total_points": int(self.total_points[to_week, i])} for i in order]
+
+    def manager(self, manager_id):
+        """A manager's rank and points in every stored gameweek they were ranked in."""
+        index = numpy.searchsorted(self.manager_ids, int(manager_id))
+        if index >= len(self.manager_ids) or self.manager_ids[index] != int(manager_id):
+            raise KeyError("no standings for manager {0}".format(manager_id))
+        return [{"game_week": int(game_week), "rank": int(self.ranks[week, index]),
+                 "game_week_points": int(self.game_week_points[week, index]),
+                 "total_points": int(self.total_points[week, index])}
+                for week, game_week in enumerate(self.game_weeks) if self.ranks[week, index]]
+
+    def _week_index(self, game_week):
+        week = numpy.searchsorted(self.game_weeks, int(game_week))
+        if week >= len(self.game_weeks) or self.game_weeks[week] != int(game_week):
+            raise KeyError("no standings for gameweek {0}".format(game_week))
+        return week
+
+
+Shard = namedtuple('Shard', ['first_page', 'last_page', 'attempts', 'not_before'])
+
+
+def current_game_week(league_id=313, base_url='http://fantasy.premierleague.com', fetcher=None):
+    standings_url = '{0}/my-leagues/{1}/standings/?ls-page=1'.format(base_url.rstrip('/'), league_id)
+    standings_html = fetcher.fetch(standings_url) if fetcher else WebRequest(standings_url).get_data()
+    first_link = StandingsScraper(standings_html).scrape_standings_relative_links()[0]
+    return LinkParser().extract_gameweek(first_link)
+
+
+def _run_shard(shard, connection_strings, controller_options, ledger_filename):
+    """Crawls one shard in a worker process with its own session, storage handlers and ledger connection."""
+    PAGE_SIZE = 50
+    started = monotonic()
+    ledger = JobLedger(ledger_filename) if ledger_filename else None
+    controller = FantasyEPLController(*connection_strings, ledger=ledger, **controller_options)
+    controller.download_manager_stats((shard.first_page - 1) * PAGE_SIZE + 1, shard.last_page * PAGE_SIZE)
+    seconds = monotonic() - started
+    return {"first_page": shard.first_page, "last_page": shard.last_page, "pid": os.getpid(),
+            "managers": controller.managers_created, "seconds": round(seconds, 2),
+            "managers_per_second": round(controller.managers_created / seconds, 2) if seconds else 0}
+
+
+class ShardCoordinator(object):
+    """Splits a rank range into shards of pages_per_shard standings pages and crawls them in worker processes.
+
+    Workers pull the next shard as they finish one, so a slow shard does not hold the others back. A shard that
+    fails is split in two and put back for any free worker, after rate_limit_cooldown seconds if the site answered
+    429 or 503, until it has failed max_attempts times. DbSaver writes are idempotent, and with a ledger finished
+    pages are skipped, so overlapping or retried shards merge into the same tables without duplicates.
+    """
+    RATE_LIMITED = (429, 503)
+
+    def __init__(self, *connection_strings, processes=4, pages_per_shard=20, max_attempts=3, rate_limit_cooldown=60,
+                 ledger_filename=None, **controller_options):
+        self.connection_strings = connection_strings
+        self.processes = processes
+        self.pages_per_shard = pages_per_shard
+        self.max_attempts = max_attempts
+        self.rate_limit_cooldown = rate_limit_cooldown
+        self.ledger_filename = ledger_filename
+        self.controller_options = controller_options
+
+    def run(self, starting_rank=1, finishing_rank=100000):
+        PAGE_SIZE = 50
+        first_page = int(float(starting_rank / PAGE_SIZE)) + 1
+        last_page = int(float(finishing_rank / PAGE_SIZE))
+        options = dict(self.controller_options)
+        if not options.get("game_week"):
+            options["game_week"] = current_game_week(options.get("league_id", 313),
+                                                     options.get("base_url", 'http://fantasy.premierleague.com'))
+        pending = deque(Shard(page, min(page + self.pages_per_shard - 1, last_page), 0, 0)
+                        for page in range(first_page, last_page + 1, self.pages_per_shard))
+        results, failures = [], []
+        started = monotonic()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.processes) as executor:
+            running = {}
+            while pending or running:
+                for _ in range(len(pending)):
+                    if len(running) >= self.processes:
+                        break
+                    shard = pending.popleft()
+                    if shard.not_before > monotonic():
+                        pending.append(shard)
+                        continue
+                    running[executor.submit(_run_shard, shard, self.connection_strings, options,
+                                            self.ledger_filename)] = shard
+                if not running:
+                    sleep(max(0, min(shard.not_before for shard in pending) - monotonic()))
+                    continue
+                done, _ = wait(running, timeout=1, return_when=FIRST_COMPLETED)
+                for future in done:
+                    shard = running.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as error:
+                        failures.extend(self._reschedule(shard, error, pending))
+                        continue
+                    results.append(result)
+                    print("Shard pages {first_page}-{last_page}: {managers} managers in {seconds}s "
+                          "({managers_per_second}/s, pid {pid}).".format(**result))
+        seconds = monotonic() - started
+        managers = sum(result["managers"] for result in results)
+        report = {"game_week": options["game_week"], "managers": managers, "seconds": round(seconds, 2),
+                  "managers_per_second": round(managers / seconds, 2) if seconds else 0,
+                  "shards": sorted(results, key=lambda result: result["first_page"]), "failed_shards": failures}
+        print("{0} managers in {1}s ({2}/s) across {3} shards, {4} failed.".format(
+            managers, report["seconds"], report["managers_per_second"], len(results), len(failures)))
+        return report
+
+    def _reschedule(self, shard, error, pending):
+        print("Shard pages {0}-{1} failed: {2!r}".format(shard.first_page, shard.last_page, error))
+        attempts = shard.attempts + 1
+        if attempts >= self.max_attempts:
+            return [{"first_page": shard.first_page, "last_page": shard.last_page, "error": repr(error)}]
+        rate_limited = isinstance(error, requests.HTTPError) and error.args and error.args[0] in self.RATE_LIMITED
+        not_before = monotonic() + self.rate_limit_cooldown if rate_limited else 0
+        middle = (shard.first_page + shard.last_page) // 2
+        if shard.first_page < shard.last_page:
+            pending.append(Shard(shard.first_page, middle, attempts, not_before))
+            pending.append(Shard(middle + 1, shard.last_page, attempts, not_before))
+        else:
+            pending.append(Shard(shard.first_page, shard.last_page, attempts, not_before))
+        return []
+
+
+CrawlJob = namedtuple('CrawlJob', ['league_id', 'season', 'connection_strings', 'starting_rank', 'finishing_rank',
+                                   'player_stats'])
+
+
+class CrawlScheduler(object):
+    """Crawls several (league, season) jobs in one process through one SharedFetcher.
+
+    The current gameweek is resolved once and handed to every controller, and a manager who is in more than one
+    league has their entry page fetched once. Jobs run parallel_jobs at a time, in the order they were added, and
+    each writes to its own storage handlers; controller_options go to every job's controller.
+
+    scheduler = CrawlScheduler(concurrency=8, ledger=JobLedger())
+    scheduler.add_job(313, 1415, connection_string, finishing_rank=10000, player_stats=True)
+    scheduler.add_job(4578, 1415, connection_string, finishing_rank=2000)
+    scheduler.run()
+    """
+    def __init__(self, base_url='http://fantasy.premierleague.com', concurrency=1, requests_per_second=None,
+                 retry_policy=None, cache=None, replay=False, metrics=None, max_shared_bytes=64 * 2 ** 20,
+                 parallel_jobs=1, **controller_options):
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.metrics = metrics if metrics is not None else METRICS
+        self.fetcher = SharedFetcher(self.concurrency * parallel_jobs, requests_per_second, retry_policy, cache,
+                                     replay, self.metrics, max_shared_bytes)
+        self.parallel_jobs = parallel_jobs
+        self.controller_options = controller_options
+        self.jobs = []
+        self._game_week = controller_options.pop("game_week", None)
+        self._game_week_lock = threading.Lock()
+
+    def add_job(self, league_id, season, *connection_strings, starting_rank=1, finishing_rank=10000,
+                player_stats=False):
+        job = CrawlJob(league_id, season, connection_strings, starting_rank, finishing_rank, player_stats)
+        self.jobs.append(job)
+        return job
+
+    def game_week(self):
+        with self._game_week_lock:
+            if self._game_week is None:
+                league_id = self.jobs[0].league_id if self.jobs else 313
+                self._game_week = current_game_week(league_id, self.base_url, self.fetcher)
+            return self._game_week
+
+    def run(self):
+        game_week = self.game_week()
+        started = monotonic()
+        with ThreadPoolExecutor(max_workers=self.parallel_jobs) as executor:
+            reports = list(executor.map(lambda job: self._run_job(job, game_week), self.jobs))
+        seconds = monotonic() - started
+        shared_hits = self.metrics.counter("shared_fetch_hits")
+        print("{0} jobs, {1} managers in {2:.2f}s, {3} fetches shared between jobs.".format(
+            len(reports), sum(report["managers"] for report in reports), seconds, shared_hits))
+        return {"game_week": game_week, "seconds": round(seconds, 2), "shared_fetch_hits": shared_hits,
+                "jobs": reports}
+
+    def _run_job(self, job, game_week):
+        started = monotonic()
+        controller = FantasyEPLController(*job.connection_strings, league_id=job.league_id, season=job.season,
+                                          concurrency=self.concurrency, base_url=self.base_url,
+                                          game_week=game_week, metrics=self.metrics, fetcher=self.fetcher,
+                                          **self.controller_options)
+        if job.player_stats:
+            controller.download_player_stats(bulk=self.concurrency > 1)
+        controller.download_manager_stats(job.starting_rank, job.finishing_rank)
+        return {"league_id": job.league_id, "season": job.season, "managers": controller.managers_created,
+                "seconds": round(monotonic() - started, 2)}
+
+
+class RankTracker(object):
+    """Streams a league's standings pages into a RankStore, fetching no entry pages, for reports that only need
+    ranks and points.
+
+    Pages are fetched concurrency at a time and read with extract_standings_rows. Without a finishing_rank the whole
+    league is read, stopping after the first page that isn't full. Pages already stored for the gameweek are skipped,
+    so an interrupted run carries on from where it stopped.
+
+    RankTracker(RankStore(), league_id=313, concurrency=8).run()
+    RankStore().history(1415, 313).rank_movement(20, 21)
+    """
+    PAGE_SIZE = 50
+
+    def __init__(self, store=None, league_id=313, season=1415, base_url='http://fantasy.premierleague.com',
+                 concurrency=1, requests_per_second=None, retry_policy=None, cache=None, replay=False, metrics=None,
+                 fetcher=None, game_week=None):
+        self.store = store if store is not None else RankStore()
+        self.league_id = league_id
+        self.season = season
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.metrics = metrics if metrics is not None else METRICS
+        self.fetcher = fetcher or Fetcher(self.concurrency, requests_per_second, retry_policy, cache, replay,
+                                          self.metrics)
+        self.game_week = game_week
+
+    def run(self, starting_rank=1, finishing_rank=None):
+        started = monotonic()
+        game_week = int(self.game_week or current_game_week(self.league_id, self.base_url, self.fetcher))
+        stored_rank = self.store.max_rank(self.season, self.league_id, game_week)
+        page = max((starting_rank - 1) // self.PAGE_SIZE, stored_rank // self.PAGE_SIZE) + 1
+        last_page = (finishing_rank - 1) // self.PAGE_SIZE + 1 if finishing_rank else None
+        pages = managers = 0
+        finished = last_page is not None and page > last_page
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while not finished:
+                window = range(page, page + self.concurrency if last_page is None
+                               else min(page + self.concurrency, last_page + 1))
+                for page, rows in zip(window, executor.map(self._standings_rows, window)):
+                    ranked = [row for row in rows
+                              if row.rank >= starting_rank and (not finishing_rank or row.rank <= finishing_rank)]
+                    self.store.append(self.season, self.league_id, game_week, ranked)
+                    pages += 1
+                    managers += len(ranked)
+                    self.metrics.increment("standings_pages")
+                    self.metrics.increment("standings_rows", len(ranked))
+                    if len(rows) < self.PAGE_SIZE or page == last_page:
+                        finished = True
+                        break
+                page += 1
+        seconds = monotonic() - started
+        print("{0} managers from {1} standings pages in {2:.2f}s.".format(managers, pages, seconds))
+        return {"game_week": game_week, "pages": pages, "managers": managers, "seconds": round(seconds, 2)}
+
+    def _standings_rows(self, page):
+        return extract_standings_rows(self.fetcher.fetch(
+            '{0}/my-leagues/{1}/standings/?ls-page={2}'.format(self.base_url, self.league_id, page)))
 
 
 class FantasyEPLController(object):
-    def __init__(self, *connection_strings, league_id=313, season=1415):
+    def __init__(self, *connection_strings, league_id=313, season=1415, concurrency=1, requests_per_second=None,
+                 base_url='http://fantasy.premierleague.com', retry_policy=None, cache=None, replay=False,
+                 parse_processes=0, queue_size=500, ledger=None, game_week=None, incremental=False, metrics=None,
+                 fetcher=None, async_writes=False, journal_directory="journal"):
         self.league_id = league_id
         self.season = season
-        self.web = WebRequest('http://fantasy.premierleague.com/my-leagues/{0}/standings/?ls-page=1'.format(league_id))
+        self.base_url = base_url.rstrip('/')
+        self.concurrency = max(1, concurrency)
+        self.parse_processes = parse_processes
+        self.queue_size = queue_size
+        self.ledger = ledger
+        self._committed_managers = set()
+        self.metrics = metrics if metrics is not None else METRICS
+        self.fetcher = fetcher or Fetcher(self.concurrency, requests_per_second, retry_policy, cache, replay,
+                                          self.metrics)
+        self.rate_limiter = self.fetcher.rate_limiter
+        self.retry_policy = self.fetcher.retry_policy
+        self.session = self.fetcher.session
+        self.cache = self.fetcher.cache
+        self.replay = self.fetcher.replay
+        if incremental and ledger is None:
+            raise ValueError("incremental crawls need a JobLedger holding last gameweek's squads")
+        self.incremental = incremental
+        self.async_writes = async_writes
+        self.journal_directory = journal_directory
+        self.player_points = {}
+        self.entries_carried = 0
+        self.entries_fetched = 0
+        self.transfers = 0
+        self._transfers_lock = threading.Lock()
+        self.player_registry = PlayerRegistry()
         self.link_parser = LinkParser()
         self.entry_scraper = EntryScraper("")
         self.standings_scraper = StandingsScraper("")
-        self.game_week = self._get_current_game_week()
+        self.managers_created = 0
+        self.game_week = game_week or self._get_current_game_week()
         self._initialise_storage_handlers(*connection_strings)
 
-    def download_player_stats(self):
+    def download_player_stats(self, bulk=False):
+        if bulk:
+            self._download_player_stats_in_bulk()
+            return
         player_id = 1
         player_stats_remaining = True
         while player_stats_remaining:
             try:
-                self.web.set_url("http://fantasy.premierleague.com/web/api/elements/{0}/".format(player_id))
-                p = PlayerStats(self.web.get_data())
+                p = PlayerStats(self._fetch(self._element_url(player_id)))
+                self.player_points[p.attributes_dict['id']] = p.attributes_dict['event_total']
+                self.metrics.increment("players")
                 for handler in self.storage_handlers:
                     handler.add_player_stats(p)
                 player_id += 1
                 print("added {0} : {1}".format(p.attributes_dict['id'], p.attributes_dict['second_name']))
-            except HTTPError:
+            except requests.HTTPError:
                 print("Completed")
                 player_stats_remaining = False
                 for handler in self.storage_handlers:
                     handler.commit()
+        self._finish_storage_handlers()
+
+    def _download_player_stats_in_bulk(self):
+        """Fetches every element concurrently and upserts the roster as one batch.
+
+        With a ledger, players whose stats match the snapshot stored on the last run are left out of the batch.
+        """
+        documents = {}
+        player_count = self._probe_player_count(documents)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            futures = dict((player_id, executor.submit(self._fetch_player_document, player_id))
+                           for player_id in range(1, player_count + 1) if player_id not in documents)
+            for player_id, future in futures.items():
+                document = future.result()
+                if document is not None:
+                    documents[player_id] = document
+        batch = PlayerBatch(self.game_week, self.season)
+        for player_id in sorted(documents):
+            batch.append(documents[player_id])
+            self.player_points[player_id] = documents[player_id]['event_total']
+        self.metrics.increment("players", len(documents))
+        digests = batch.digests()
+        if self.ledger:
+            stored_digests = self.ledger.player_digests(self.season)
+            digests = dict((player_id, digest) for player_id, digest in digests.items()
+                           if stored_digests.get(player_id) != digest)
+            batch = batch.select(digests)
+        rejected = []
+        for handler in self.storage_handlers:
+            handler.add_player_batch(batch)
+            rejected.append(handler.commit())
+        self._finish_storage_handlers()
+        if self.ledger and not any(rejected):
+            self.ledger.save_player_digests(self.season, digests)
+        print("Completed: {0} of {1} players changed.".format(len(batch), len(documents)))
+
+    def _probe_player_count(self, documents):
+        """Finds the highest element id by doubling until a request fails and then bisecting, keeping whatever
+        documents the probes fetched."""
+        found, missing = 0, 1
+        while True:
+            document = self._fetch_player_document(missing)
+            if document is None:
+                break
+            documents[missing] = document
+            found, missing = missing, missing * 2
+        while missing - found > 1:
+            middle = (found + missing) // 2
+            document = self._fetch_player_document(middle)
+            if document is None:
+                missing = middle
+            else:
+                documents[middle] = document
+                found = middle
+        return found
+
+    def _fetch_player_document(self, player_id):
+        """The element's document, or None if there is no such element. Any other error is raised, since a
+        transient one taken for a missing element would cut the roster short."""
+        try:
+            return json_loads(self._fetch(self._element_url(player_id)))
+        except requests.HTTPError as error:
+            if error.args and error.args[0] == 404:
+                return None
+            raise
 
     def download_manager_stats(self, starting_rank=1, finishing_rank=10000):
         PAGE_SIZE = 50
@@ -395,25 +2764,124 @@ class FantasyEPLController(object):
         print("Processing pages {0} through {1} for a total of {2} records.".format(standings_page_index,
                                                                                     standings_page_total,
                                                                                     total_records))
-        while standings_page_index <= standings_page_total:
-            # sleep(1)
-            url = 'http://fantasy.premierleague.com/my-leagues/{0}/standings/?ls-page={1}'.format(self.league_id,
-                                                                                                  standings_page_index)
-            print("Processing page {0}.".format(standings_page_index))
-            self.web.set_url(url)
-            self.standings_scraper.set_source_data(self.web.get_data())
-            links = self.standings_scraper.scrape_standings_relative_links()
-            self._process_standings_page(links)
-            print("Page {0} added.".format(standings_page_index))
-            standings_page_index += 1
+        pages = range(standings_page_index, standings_page_total + 1)
+        self._committed_managers = set()
+        if self.ledger:
+            self.ledger.record_run(self.season, self.game_week, self.league_id, starting_rank, finishing_rank)
+            committed_pages = self.ledger.committed_pages(self.season, self.game_week, self.league_id)
+            self._committed_managers = self.ledger.committed_managers(self.season, self.game_week, self.league_id)
+            pages = [page for page in pages if page not in committed_pages]
+            print("Skipping {0} pages already committed.".format(standings_page_total + 1 - standings_page_index
+                                                                  - len(pages)))
+        try:
+            if self.concurrency > 1:
+                CrawlPipeline(self, self.parse_processes, self.queue_size).run(pages)
+            else:
+                for page in pages:
+                    print("Processing page {0}.".format(page))
+                    rows = self._scrape_standings_rows(self._fetch(self._standings_url(page)))
+                    links = self._pending_links([row.link for row in rows])
+                    entries = self._process_standings_page(links, self._carried_records(rows, links))
+                    if entries is None:
+                        print("Page {0} is incomplete and was not marked committed.".format(page))
+                        continue
+                    self._mark_page_committed(page, entries)
+                    print("Page {0} added.".format(page))
+        finally:
+            self._finish_storage_handlers()
+        print("{0} entry pages fetched, {1} squads carried forward, {2} players transferred in.".format(
+            self.entries_fetched, self.entries_carried, self.transfers))
+        retry_stats = self.retry_policy.stats()
+        print("{0} retries, {1} circuit breaker trips.".format(retry_stats["retries"], retry_stats["breaker_trips"]))
+
+    def _pending_links(self, links):
+        if not self._committed_managers:
+            return links
+        return [link for link in links if self.link_parser.extract_player_id(link) not in self._committed_managers]
+
+    def _carried_records(self, rows, links):
+        """Entry records for the managers on a standings page whose stored squad still explains their gameweek
+        points, built without fetching their entry pages.
+
+        A squad is carried forward when it was stored last gameweek and its starters' points this gameweek, with the
+        captain counted twice, add up to the points on the standings page. Hits, chips, automatic substitutions and
+        most transfers and bench or captain changes change the sum, so those entry pages are fetched as usual. A
+        change between players on equal points does not, so squads whose captain scored the same as another starter,
+        or whose starters share a score with a bench player, are fetched too. A transfer for a player outside the
+        squad on the same points can't be told apart and is carried as the old squad. A carried squad is stored as its
+        GameWeekTeam row alone, whose squad_game_week names the gameweek that holds its Manager and Position rows.
+        Needs the player points from download_player_stats, without which every entry page is fetched.
+        """
+        carried = {}
+        if self.incremental and self.player_points:
+            pending = set(links)
+            rows = [row for row in rows if row.link in pending]
+            squads = self.ledger.squads(self.season, [self.link_parser.extract_player_id(row.link) for row in rows])
+            for row in rows:
+                squad = squads.get(self.link_parser.extract_player_id(row.link))
+                if squad and self._carries_forward(squad, row):
+                    carried[row.link] = self._carried_record(squad, row)
+        self.entries_carried += len(carried)
+        self.entries_fetched += len(links) - len(carried)
+        self.metrics.increment("entries_carried", len(carried))
+        self.metrics.increment("entries_fetched", len(links) - len(carried))
+        return carried
+
+    def _carries_forward(self, squad, row):
+        if squad.game_week not in (int(self.game_week) - 1, int(self.game_week)) or squad.captain_index is None:
+            return False
+        if any(player_id not in self.player_points for player_id in squad.player_ids):
+            return False
+        points = [self.player_points[player_id] for player_id in squad.player_ids]
+        starter_points, bench_points = points[:11], points[11:]
+        captain_points = points[squad.captain_index]
+        if starter_points.count(captain_points) > 1 or set(starter_points) & set(bench_points):
+            # the captaincy or a bench swap could have moved without changing the sum
+            return False
+        return sum(starter_points) + captain_points == row.game_week_points
+
+    def _carried_record(self, squad, row):
+        return EMPTY_ENTRY._replace(manager_name=row.manager_name, team_name=row.team_name, club=squad.club,
+                                    country=squad.country, overall_points=row.total_points, overall_rank=row.rank,
+                                    game_week_points=row.game_week_points, player_ids=squad.player_ids,
+                                    names=tuple(self.player_registry.get(player_id).name
+                                                for player_id in squad.player_ids),
+                                    positions=squad.positions, captain_index=squad.captain_index,
+                                    vice_captain_index=squad.vice_captain_index,
+                                    squad_game_week=squad.squad_game_week)
+
+    def _mark_page_committed(self, page, entries):
+        self.metrics.increment("pages")
+        if self.ledger:
+            transfers = self.ledger.mark_page_committed(self.season, self.game_week, self.league_id, page,
+                                                        [manager_id for manager_id, _ in entries], entries)
+            with self._transfers_lock:
+                self.transfers += transfers
+
+    def _fetch(self, url):
+        return self.fetcher.fetch(url)
+
+    def _standings_url(self, page):
+        return '{0}/my-leagues/{1}/standings/?ls-page={2}'.format(self.base_url, self.league_id, page)
+
+    def _entry_url(self, link):
+        return self.base_url + link
+
+    def _element_url(self, player_id):
+        return '{0}/web/api/elements/{1}/'.format(self.base_url, player_id)
+
+    def _scrape_standings_links(self, standings_html):
+        self.standings_scraper.set_source_data(standings_html)
+        return self.standings_scraper.scrape_standings_relative_links()
+
+    def _scrape_standings_rows(self, standings_html):
+        self.standings_scraper.set_source_data(standings_html)
+        return self.standings_scraper.scrape_standings_rows()
 
     def _get_current_game_week(self):
-            self.web.set_url(('http://fantasy.premierleague.com/my-leagues/{0}/standings'
-                              '/?ls-page=1').format(self.league_id))
-            standings_html = self.web.get_data()
-            self.standings_scraper.set_source_data(standings_html)
+            standings_html = self._fetch(self._standings_url(1))
             FIRST_LINK_INDEX = 0
-            first_link = self.standings_scraper.scrape_standings_relative_links()[FIRST_LINK_INDEX]
+            first_link = self._scrape_standings_links(standings_html)[FIRST_LINK_INDEX]
             self.entry_scraper.set_source_data(first_link)
             return self.link_parser.extract_gameweek(first_link)
 
@@ -421,31 +2889,59 @@ class FantasyEPLController(object):
         self.storage_handlers = []
         if connection_strings:
             for connection_string in connection_strings:
-                handler = DbSaver(self.game_week, connection_string, self.season)
-                self.storage_handlers.append(handler)
+                self.storage_handlers.append(self._create_storage_handler(connection_string))
         else:
             default_connection_string = ("DRIVER={MySQL ODBC 5.3 Unicode Driver};SERVER=localhost;DATABASE=epl_15_16;"
                                          "USER=root;PASSWORD=admin;OPTION=67108864;")
-            default_db = DbSaver(self.game_week, default_connection_string, self.season)
+            default_db = DbSaver(self.game_week, default_connection_string, self.season, metrics=self.metrics)
             self.storage_handlers.append(default_db)
 
-    def _process_standings_page(self, links):
-        for link in links:
-            # sleep(1)
-            url = 'http://fantasy.premierleague.com' + link
-            self.web.set_url(url)
-            self.entry_scraper.set_source_data(self.web.get_data())
-            man = self._create_manager(link)
-            team = self._create_game_week_team()
+    def _create_storage_handler(self, connection_string):
+        if connection_string.startswith("parquet:"):
+            # the ledger marks a page committed as soon as commit() returns, so its rows must be in closed files
+            return ParquetSaver(self.game_week, connection_string[len("parquet:"):], self.season, metrics=self.metrics,
+                                close_on_commit=self.ledger is not None)
+        if self.async_writes:
+            # sqlite serialises writers anyway, so more than one would only wait on its lock
+            return AsyncDbSaver(self.game_week, connection_string, self.season,
+                                writers=1 if connection_string.startswith("sqlite:") else 2,
+                                journal_directory=self.journal_directory, metrics=self.metrics)
+        return DbSaver(self.game_week, connection_string, self.season, metrics=self.metrics)
+
+    def _finish_storage_handlers(self):
+        for handler in self.storage_handlers:
+            finish = getattr(handler, "finish", None)
+            if finish:
+                finish()
+
+    def _process_standings_page(self, links, carried=None):
+        carried = carried or {}
+        return self._store_entries(links, (carried[link] if link in carried else self._fetch(self._entry_url(link))
+                                           for link in links))
+
+    def _store_entries(self, links, entry_pages):
+        """Stores entry pages, or records already carried forward, and returns their (manager_id, record) pairs, or
+        None if a database rejected some of their rows."""
+        entries = []
+        for link, entry_page in zip(links, entry_pages):
+            record = entry_page
+            if not isinstance(entry_page, EntryRecord):
+                with self.metrics.timer("entry_parse_seconds"):
+                    record = parse_entry(entry_page)
+            man, team = self._create_manager_and_team(link, record)
 
             for handler in self.storage_handlers:
-                handler.add_manager(man)
-                handler.add_game_week_team(team, man.id)
-                for player in team.players:
-                    handler.add_player(player, man.id)
+                handler.add_entry(man, team)
+            entries.append((man.id, record))
 
-        for handler in self.storage_handlers:
-            handler.commit()
+        rejected = [handler.commit() for handler in self.storage_handlers]
+        return None if any(rejected) else entries
+
+    def _create_manager_and_team(self, link, record):
+        self.entry_scraper.set_record(record)
+        team = self._create_game_week_team()
+        team.squad_game_week = record.squad_game_week
+        return self._create_manager(link), team
 
     def _create_manager(self, link):
         man = Manager()
@@ -454,10 +2950,12 @@ class FantasyEPLController(object):
         man.name = self.entry_scraper.scrape_manager_name()
         man.team_name = self.entry_scraper.scrape_team_name()
         man.id = self.link_parser.extract_player_id(link)
+        self.managers_created += 1
+        self.metrics.increment("managers")
         return man
 
     def _create_game_week_team(self):
-        team = GameWeekTeam()
+        team = GameWeekTeam(self.player_registry)
         team.game_week_points = self.entry_scraper.scrape_game_week_points()
         team.overall_points = self.entry_scraper.scrape_overall_points()
         team.overall_rank = self.entry_scraper.scrape_overall_rank()
@@ -470,10 +2968,197 @@ class FantasyEPLController(object):
         return team
 
 
+def _create_cache(options):
+    if options.replay and not options.cache:
+        raise SystemExit("--replay needs --cache")
+    return ResponseCache(options.cache, options.cache_ttl) if options.cache else None
+
+
+def _create_controller(options, **controller_options):
+    return FantasyEPLController(*options.targets, league_id=options.league_id, season=options.season,
+                                concurrency=options.concurrency, requests_per_second=options.requests_per_second,
+                                base_url=options.base_url, game_week=options.game_week,
+                                cache=_create_cache(options), replay=options.replay,
+                                ledger=JobLedger(options.ledger) if options.ledger else None,
+                                async_writes=options.async_writes, journal_directory=options.journal,
+                                **controller_options)
+
+
+def _players_command(options):
+    _create_controller(options).download_player_stats(bulk=options.bulk)
+
+
+def _managers_command(options):
+    controller = _create_controller(options, parse_processes=options.parse_processes,
+                                    incremental=options.incremental)
+    if options.incremental:
+        controller.download_player_stats(bulk=True)
+    controller.download_manager_stats(options.starting_rank, options.finishing_rank)
+
+
+def _resume_command(options):
+    last_run = JobLedger(options.ledger).last_run() if options.ledger else None
+    if last_run is None:
+        raise SystemExit("resume needs --ledger holding an earlier manager crawl")
+    options.season, options.game_week, options.league_id, starting_rank, finishing_rank = last_run
+    _create_controller(options, parse_processes=options.parse_processes).download_manager_stats(starting_rank,
+                                                                                                finishing_rank)
+
+
+def _export_command(options):
+    source = options.source
+    if source.startswith("parquet:"):
+        analytics = EliteAnalytics.from_parquet(source[len("parquet:"):])
+    else:
+        connection = sqlite3.connect(source[len("sqlite:"):]) if source.startswith("sqlite:") else \
+            pyodbc.connect(source)
+        analytics = EliteAnalytics.from_connection(connection)
+    game_weeks = [options.game_week] if options.game_week else [int(week) for week in analytics.game_weeks]
+    reports = dict((game_week, {"elite_utilization": analytics.elite_utilization(game_week, top=options.top),
+                                "most_captained": analytics.most_captained(game_week, top=options.top),
+                                "most_vice_captained": analytics.most_vice_captained(game_week, top=options.top)})
+                   for game_week in game_weeks)
+    output = json.dumps(reports, indent=2, default=lambda value: value.item())
+    if options.output:
+        with open(options.output, 'w', encoding='UTF-8') as file:
+            file.write(output)
+    else:
+        print(output)
+
+
+def _ranks_command(options):
+    RankTracker(RankStore(options.store), options.league_id, options.season, options.base_url, options.concurrency,
+                options.requests_per_second, cache=_create_cache(options), replay=options.replay,
+                game_week=options.game_week).run(options.starting_rank, options.finishing_rank)
+
+
+def _movement_command(options):
+    history = RankStore(options.store).history(options.season, options.league_id,
+                                               [options.from_game_week, options.to_game_week])
+    print(json.dumps(history.rank_movement(options.from_game_week, options.to_game_week, options.top,
+                                           options.fallers), indent=2))
+
+
+def _replay_command(options):
+    caught_up = True
+    for target in options.targets:
+        saver = AsyncDbSaver(0, target, options.season, journal_directory=options.journal)
+        saver.retry_rejected()
+        caught_up = saver.finish() and caught_up
+    if not caught_up:
+        raise SystemExit(1)
+
+
+def _status_command(options):
+    if not options.ledger:
+        raise SystemExit("status needs --ledger")
+    ledger = JobLedger(options.ledger)
+    print(json.dumps({"last_run": ledger.last_run(), "pages": ledger.summary()}, indent=2))
+
+
+def _game_week_command(options):
+    print(current_game_week(options.league_id, options.base_url))
+
+
+def _bench_command(options):
+    import EPL_bench
+    EPL_bench.main(options.bench_arguments)
+
+
+def main(arguments=None):
+    """Command line entry point. Only what a command uses is imported: gameweek and status never load the
+    database drivers, and nothing but the crawls connects to a database."""
+    import argparse
+    fetching = argparse.ArgumentParser(add_help=False)
+    fetching.add_argument("--league-id", type=int, default=313)
+    fetching.add_argument("--season", type=int, default=1415)
+    fetching.add_argument("--base-url", default='http://fantasy.premierleague.com')
+    fetching.add_argument("--game-week", type=int, help="skip resolving the current gameweek")
+    fetching.add_argument("--concurrency", type=int, default=1)
+    fetching.add_argument("--requests-per-second", type=float)
+    fetching.add_argument("--cache", help="ResponseCache directory")
+    fetching.add_argument("--cache-ttl", type=float,
+                          help="seconds a cached page is served without asking the site; revalidated when not given")
+    fetching.add_argument("--replay", action="store_true", help="serve every page from --cache, never the network")
+    fetching.add_argument("--metrics-port", type=int, help="serve metrics on this local port while crawling")
+    fetching.add_argument("--metrics-file", help="dump metrics as json to this file while crawling")
+    crawl = argparse.ArgumentParser(add_help=False, parents=[fetching])
+    crawl.add_argument("targets", nargs="*", metavar="connection_string",
+                       help="ODBC connection strings, sqlite:<file> or parquet:<directory>; the local MySQL "
+                            "database when none are given")
+    crawl.add_argument("--ledger", help="JobLedger file recording committed pages")
+    crawl.add_argument("--async-writes", action="store_true",
+                       help="write each database from its own threads, journalling what it can't take yet")
+    crawl.add_argument("--journal", default="journal", help="directory of the --async-writes journals")
+
+    parser = argparse.ArgumentParser(description="Crawls the Fantasy Premier League elite managers.")
+    commands = parser.add_subparsers(dest="command")
+    players = commands.add_parser("players", parents=[crawl], help="download every player's stats")
+    players.add_argument("--bulk", action="store_true", help="fetch concurrently and upsert as one batch")
+    players.set_defaults(run=_players_command)
+    managers = commands.add_parser("managers", parents=[crawl], help="download managers and squads by rank")
+    managers.add_argument("--from", dest="starting_rank", type=int, default=1)
+    managers.add_argument("--to", dest="finishing_rank", type=int, default=10000)
+    managers.add_argument("--parse-processes", type=int, default=0)
+    managers.add_argument("--incremental", action="store_true",
+                          help="carry forward squads that last gameweek's ledger still explains")
+    managers.set_defaults(run=_managers_command)
+    resume = commands.add_parser("resume", parents=[crawl], help="finish the last manager crawl in --ledger")
+    resume.add_argument("--parse-processes", type=int, default=0)
+    resume.set_defaults(run=_resume_command)
+    ranks = commands.add_parser("ranks", parents=[fetching], help="store ranks and points from the standings only")
+    ranks.add_argument("--store", default="ranks", help="RankStore directory")
+    ranks.add_argument("--from", dest="starting_rank", type=int, default=1)
+    ranks.add_argument("--to", dest="finishing_rank", type=int, help="the whole league when not given")
+    ranks.set_defaults(run=_ranks_command)
+    movement = commands.add_parser("movement", help="print the biggest rank movements between two gameweeks")
+    movement.add_argument("from_game_week", type=int)
+    movement.add_argument("to_game_week", type=int)
+    movement.add_argument("--store", default="ranks")
+    movement.add_argument("--league-id", type=int, default=313)
+    movement.add_argument("--season", type=int, default=1415)
+    movement.add_argument("--top", type=int, default=50)
+    movement.add_argument("--fallers", action="store_true", help="the managers who fell furthest instead")
+    movement.set_defaults(run=_movement_command)
+    replay = commands.add_parser("replay", help="write the journals left by --async-writes crawls")
+    replay.add_argument("targets", nargs="+", metavar="connection_string")
+    replay.add_argument("--season", type=int, default=1415)
+    replay.add_argument("--journal", default="journal")
+    replay.set_defaults(run=_replay_command)
+    export = commands.add_parser("export", help="write the data filters reports as json")
+    export.add_argument("source", help="sqlite:<file>, parquet:<directory> or an ODBC connection string")
+    export.add_argument("--game-week", type=int, help="every stored gameweek when not given")
+    export.add_argument("--top", type=int, default=50)
+    export.add_argument("--output")
+    export.set_defaults(run=_export_command)
+    status = commands.add_parser("status", help="summarise the pages committed in a ledger")
+    status.add_argument("--ledger", required=True)
+    status.set_defaults(run=_status_command)
+    game_week = commands.add_parser("gameweek", help="print the current gameweek")
+    game_week.add_argument("--league-id", type=int, default=313)
+    game_week.add_argument("--base-url", default='http://fantasy.premierleague.com')
+    game_week.set_defaults(run=_game_week_command)
+    bench = commands.add_parser("bench", help="run EPL_bench.py with the remaining arguments")
+    bench.add_argument("bench_arguments", nargs=argparse.REMAINDER)
+    bench.set_defaults(run=_bench_command)
+    options = parser.parse_args(arguments)
+
+    if options.command is None:
+        # the original behaviour: every player and the top 10000 managers into the local database
+        epl = FantasyEPLController()
+        epl.download_player_stats()
+        epl.download_manager_stats(1, 10000)
+        return
+    with ExitStack() as stack:
+        if getattr(options, "metrics_port", None):
+            stack.enter_context(MetricsServer(port=options.metrics_port))
+        if getattr(options, "metrics_file", None):
+            stack.enter_context(MetricsDumper(options.metrics_file))
+        options.run(options)
+
+
 if __name__ == '__main__':
-    epl = FantasyEPLController()
-    epl.download_player_stats()
-    epl.download_manager_stats(1, 10000)
+    main()
 
     # TODO: - better logging, docstrings, refactoring
 
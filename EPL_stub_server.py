@@ -0,0 +1,238 @@
+__author__ = 'Jeremy'
+import argparse
+import json
+import os
+import random
+import re
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import sleep
+
+TEMPLATE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "html templates")
+PAGE_SIZE = 50
+
+
+def load_template(name):
+    with open(os.path.join(TEMPLATE_DIRECTORY, name), 'r', encoding='UTF-8') as file:
+        return file.read()
+
+
+STANDINGS_ROW = """
+                <tr >
+                    <td><img width="10" height="10" src="http://cdn.ismfg.net/static/img/{movement}.png"></td>
+                    <td>{rank}</td>
+                    <td><a href="/entry/{manager_id}/event-history/{game_week}/">{team_name}</a></td>
+                    <td>{manager_name}</td>
+                    <td>{game_week_points}</td>
+                    <td>{total_points:,}</td>
+                </tr>
+            """
+
+# the element fields PlayerStats drops, which the live api still sends
+DROPPED_ELEMENT_FIELDS = ("photo", "event_explain", "fixture_history", "season_history", "fixtures", "loans_in",
+                          "loans_out", "loaned_in", "loaned_out", "current_fixture", "next_fixture", "status", "code",
+                          "cost_change_start", "cost_change_event", "cost_change_start_fall", "cost_change_event_fall",
+                          "transfers_out_event", "transfers_in_event", "event_points", "ep_this", "ep_next", "special")
+
+
+class SyntheticLeague(object):
+    """A league of managers managers and players players built from the html templates.
+
+    Manager ids, squads, captains and points are drawn from seed, so the same arguments always serve the same
+    pages. Entry pages are Entry.txt with the squad's player ids swapped in; standings pages are Standings.txt with
+    fifty generated rows, ranked by total points.
+    """
+    FIRST_MANAGER_ID = 100000
+
+    def __init__(self, managers=10000, players=600, game_week=21, seed=1415):
+        self.managers = managers
+        self.players = players
+        self.game_week = game_week
+        self.seed = seed
+        standings = load_template("Standings.txt")
+        rows_start = standings.index("\n                <tr >", standings.index("ismStandingsTable"))
+        rows_end = standings.index("</table>", rows_start)
+        self._standings_head = standings[:rows_start]
+        self._standings_tail = standings[rows_end:]
+        entry = load_template("Entry.txt")
+        # the squad's ids sit in the pitch elements' json and in their info links
+        id_pattern = re.compile(r"""class='ismPitchElement\s*\{[^']*?"id": ([0-9]+)|href="#([0-9]+)" class="ismInfo""")
+        template_ids, spans = [], []
+        for match in id_pattern.finditer(entry):
+            group = 1 if match.group(1) else 2
+            if int(match.group(group)) not in template_ids:
+                template_ids.append(int(match.group(group)))
+            spans.append((match.span(group), template_ids.index(int(match.group(group)))))
+        self._entry_pieces = [entry[:spans[0][0][0]]]
+        for i, ((_, end), _) in enumerate(spans):
+            self._entry_pieces.append(entry[end:spans[i + 1][0][0]] if i + 1 < len(spans) else entry[end:])
+        self._entry_slots = [slot for _, slot in spans]
+
+    def manager_id(self, rank):
+        return self.FIRST_MANAGER_ID + rank
+
+    def squad(self, manager_id):
+        return random.Random(self.seed * 1000003 + manager_id).sample(range(1, self.players + 1), 15)
+
+    def standings_page(self, page):
+        rows = []
+        for rank in range((page - 1) * PAGE_SIZE + 1, min(page * PAGE_SIZE, self.managers) + 1):
+            generator = random.Random(self.seed * 7919 + rank)
+            manager_id = self.manager_id(rank)
+            rows.append(STANDINGS_ROW.format(movement=generator.choice(("up", "down", "same")), rank=rank,
+                                             manager_id=manager_id, game_week=self.game_week,
+                                             team_name="Team {0}".format(manager_id),
+                                             manager_name="Manager {0}".format(manager_id),
+                                             game_week_points=generator.randint(20, 110),
+                                             total_points=2000 - rank // 10))
+        return self._standings_head + "".join(rows) + self._standings_tail
+
+    def entry_page(self, manager_id):
+        if not self.FIRST_MANAGER_ID < manager_id <= self.FIRST_MANAGER_ID + self.managers:
+            return None
+        squad = self.squad(manager_id)
+        pieces = [self._entry_pieces[0]]
+        for slot, piece in zip(self._entry_slots, self._entry_pieces[1:]):
+            pieces.append(str(squad[slot]))
+            pieces.append(piece)
+        return "".join(pieces)
+
+    def element(self, player_id):
+        if not 1 <= player_id <= self.players:
+            return None
+        generator = random.Random(self.seed * 104729 + player_id)
+        element = dict((field, None) for field in DROPPED_ELEMENT_FIELDS)
+        element.update(
+            id=player_id, web_name="Player {0}".format(player_id), first_name="First", second_name=str(player_id),
+            event_total=generator.randint(0, 15), type_name="Midfielder", team_name="Arsenal", team_code=3,
+            team_id=1, team=1, element_type=generator.randint(1, 4), news="", now_cost=generator.randint(40, 130),
+            total_points=generator.randint(0, 200), minutes=generator.randint(0, 1890),
+            selected_by="{0:.1f}".format(generator.uniform(0, 50)),
+            selected_by_percent="{0:.1f}".format(generator.uniform(0, 50)),
+            form="{0:.1f}".format(generator.uniform(0, 10)), value_form="{0:.1f}".format(generator.uniform(0, 2)),
+            value_season="{0:.1f}".format(generator.uniform(0, 20)),
+            points_per_game="{0:.1f}".format(generator.uniform(0, 8)), chance_of_playing_this_round=100,
+            chance_of_playing_next_round=100, in_dreamteam=False, dreamteam_count=generator.randint(0, 5),
+            transfers_in=generator.randint(0, 10 ** 6), transfers_out=generator.randint(0, 10 ** 6),
+            goals_scored=generator.randint(0, 20), assists=generator.randint(0, 15),
+            clean_sheets=generator.randint(0, 15), goals_conceded=generator.randint(0, 40), own_goals=0,
+            penalties_saved=0, penalties_missed=0, yellow_cards=generator.randint(0, 8), red_cards=0,
+            saves=generator.randint(0, 80), bonus=generator.randint(0, 20), ea_index=generator.randint(0, 500),
+            bps=generator.randint(0, 600))
+        return json.dumps(element)
+
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    routes = [
+        (re.compile(r'^/my-leagues/[0-9]+/standings/?(?:\?ls-page=(?P<page>[0-9]+))?'), 'standings_page'),
+        (re.compile(r'^/entry/(?P<manager_id>[0-9]+)/event-history/[0-9]+/?'), 'entry_page'),
+        (re.compile(r'^/web/api/elements/(?P<player_id>[0-9]+)/?'), 'element'),
+    ]
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            sleep(server.latency * (0.5 + server.random.random()))
+        if server.error_rate and server.random.random() < server.error_rate:
+            # drop the connection without a response, which the crawler retries like a timeout
+            self.close_connection = True
+            return
+        for pattern, page in self.routes:
+            match = pattern.match(self.path)
+            if match:
+                body = server.page(page, match.groupdict())
+                if body is None:
+                    break
+                content_type = "application/json" if page == 'element' else "text/html; charset=utf-8"
+                body = body.encode('UTF-8')
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+        self.send_error(404)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, league=None, latency=0, error_rate=0, seed=1415):
+        super(StubHTTPServer, self).__init__(address, StubRequestHandler)
+        self.league = league
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.standings_template = load_template("Standings.txt")
+        self.entry_template = load_template("Entry.txt")
+
+    def page(self, page, arguments):
+        if self.league is None:
+            # without a league every standings and entry url serves its template as is, and there are no elements
+            return {'standings_page': self.standings_template, 'entry_page': self.entry_template}.get(page)
+        if page == 'standings_page':
+            return self.league.standings_page(int(arguments['page'] or 1))
+        if page == 'entry_page':
+            return self.league.entry_page(int(arguments['manager_id']))
+        return self.league.element(int(arguments['player_id']))
+
+
+class StubServer(object):
+    """Serves the pages in html templates/ on localhost so crawls can be run without touching the live site.
+
+    with StubServer() as server:
+        FantasyEPLController(connection_string, base_url=server.url).download_manager_stats(1, 100)
+
+    Given a SyntheticLeague it serves that league's standings, entry pages and element api instead. latency seconds,
+    give or take half, are added to every request, and error_rate of requests have their connection dropped.
+    """
+    def __init__(self, port=0, league=None, latency=0, error_rate=0, seed=1415):
+        self.httpd = StubHTTPServer(('127.0.0.1', port), league, latency, error_rate, seed)
+        self._thread = None
+
+    @property
+    def url(self):
+        return "http://127.0.0.1:{0}".format(self.httpd.server_address[1])
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+
+def serve(port=8000, managers=None, players=600, latency=0, error_rate=0, seed=1415, ready=None):
+    """Runs a stub server until interrupted. ready, if given, is a queue that is sent the server's url."""
+    league = SyntheticLeague(managers, players, seed=seed) if managers else None
+    server = StubServer(port, league, latency, error_rate, seed)
+    if ready is not None:
+        ready.put(server.url)
+    else:
+        print("Serving html templates on {0}".format(server.url))
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        server.httpd.server_close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serves the html templates as a stand in for the live site.")
+    parser.add_argument("port", type=int, nargs="?", default=8000)
+    parser.add_argument("--managers", type=int, help="serve a synthetic league of this many managers")
+    parser.add_argument("--players", type=int, default=600)
+    parser.add_argument("--latency", type=float, default=0, help="seconds added to every request")
+    parser.add_argument("--error-rate", type=float, default=0, help="share of requests to drop")
+    options = parser.parse_args()
+    serve(options.port, options.managers, options.players, options.latency, options.error_rate)
@@ -6,10 +6,14 @@ select count(*) from gameweekteam where game_week = 28;
 select (count(position.id)  / (select count(*) from gameweekteam where game_week = 25)) * 100 as 'elite_util',
 	count(position.id) as count, web_name, selected_by_percent, now_cost, total_points, gameweekteam.game_week,
     minutes/total_points as min_per_point, points_per_game, transfers_in - transfers_out as net_xfer
-from position, player, gameweekteam 
+from position, player, gameweekteam, gameweekteam squad
 where player.id = position.id
 and gameweekteam.game_week = 28 
-and gameweekteam.gameWeekTeamID = position.gameWeekTeamID
+-- a carried squad's positions are stored under the gameweek it was carried from
+and squad.managerID = gameweekteam.managerID
+and squad.season = gameweekteam.season
+and squad.game_week = coalesce(gameweekteam.squad_game_week, gameweekteam.game_week)
+and squad.gameWeekTeamID = position.gameWeekTeamID
 and element_type = 3
 -- and started = true
 -- and now_cost < 51
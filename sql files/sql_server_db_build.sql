@@ -19,6 +19,7 @@ wildcard_available bit,
 worth decimal(5,2),
 bank decimal (5,2),
 managerID int,
+unique (managerID, game_week, season),
 foreign key (managerID) references Manager (managerID) 
 );
 
@@ -77,6 +78,7 @@ season int,
 overall_points int,
 overall_rank int,
 game_week_points int,
+squad_game_week int,
 captainID int, 
 vice_captainID int, 
 managerID int,
@@ -91,6 +93,7 @@ positionID integer NOT NULL Identity(1,1) PRIMARY KEY,
 id int,
 gameWeekTeamID varchar(15),
 started bit,
+unique (gameWeekTeamID, id),
 foreign key (id) references Player(id),
 foreign key (gameWeekTeamID) references GameWeekTeam(gameWeekTeamID)
 );
\ No newline at end of file
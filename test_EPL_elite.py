@@ -0,0 +1,224 @@
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import unittest
+from collections import namedtuple
+from decimal import Decimal
+
+import EPL_bench
+import EPL_elite
+from EPL_elite import EMPTY_ENTRY, EntryScraper, StandingsScraper, extract_standings_rows, parse_entry
+from EPL_stub_server import StubServer, SyntheticLeague, load_template
+
+
+class EntryScraperParityTest(unittest.TestCase):
+    """Every EntryScraper accessor against the values the BeautifulSoup scraper read from Entry.txt."""
+    PLAYER_IDS = [318, 207, 80, 562, 23, 89, 245, 381, 393, 522, 284, 476, 558, 388, 60]
+    NAMES = ['Green', 'Wisdom', 'Terry', 'Mangala', 'Sánchez', 'Hazard', 'Silva', 'Sigurdsson', 'Kane', 'Costa',
+             'Rooney', 'Myhill', 'Cissokho', 'Bentaleb', 'Duff']
+
+    @classmethod
+    def setUpClass(cls):
+        cls.scraper = EntryScraper(load_template("Entry.txt"))
+
+    def test_squad(self):
+        self.assertEqual(self.scraper.scrape_player_ids(), self.PLAYER_IDS)
+        self.assertEqual(self.scraper.scrape_names(), self.NAMES)
+        self.assertEqual(self.scraper.scape_player_positions(), list(range(1, 16)))
+
+    def test_captains(self):
+        self.assertEqual(self.scraper.scrape_captain_index(), 9)
+        self.assertEqual(self.scraper.scrape_vice_captain_index(), 4)
+
+    def test_def_list(self):
+        self.assertEqual(self.scraper.scrape_overall_points(), 1320)
+        self.assertEqual(self.scraper.scrape_overall_rank(), 14)
+        self.assertEqual(self.scraper.scrape_total_players(), 3426926)
+        self.assertEqual(self.scraper.scrape_game_week_points(), 69)
+        self.assertEqual(self.scraper.scrape_total_transfers(), 22)
+        self.assertEqual(self.scraper.scrape_game_week_transfers(), 0)
+        self.assertEqual(self.scraper.scrape_wild_card_used(), False)
+        self.assertEqual(self.scraper.scrape_team_value(), Decimal('104.8'))
+        self.assertEqual(self.scraper.scrape_bank(), Decimal('1.7'))
+
+    def test_manager(self):
+        self.assertEqual(self.scraper.scrape_team_name(), "MJ's XI")
+        self.assertEqual(self.scraper.scrape_manager_name(), 'Moiz Attarwala')
+        self.assertEqual(self.scraper.scrape_favorite_club(), 'Chelsea')
+        self.assertEqual(self.scraper.scrape_country(), 'India')
+
+    def test_empty_page(self):
+        self.assertEqual(parse_entry(""), EMPTY_ENTRY)
+
+
+class StandingsExtractionTest(unittest.TestCase):
+    """extract_standings_rows against StandingsScraper on Standings.txt, as served and with its markup drifted."""
+    @classmethod
+    def setUpClass(cls):
+        cls.page = load_template("Standings.txt")
+        cls.expected = StandingsScraper(cls.page).scrape_standings_rows()
+
+    def test_template(self):
+        self.assertEqual(len(self.expected), 50)
+        self.assertEqual(extract_standings_rows(self.page), self.expected)
+
+    def test_whitespace_and_attributes(self):
+        for page in (self.page.replace('<td><a href=', '<td> <a href='),
+                     self.page.replace('<a href="/entry', '<a class="x" href="/entry'),
+                     self.page.replace('<td>', '<TD class="cell">')):
+            self.assertEqual(extract_standings_rows(page), self.expected)
+
+    def test_unmatched_rows_fall_back(self):
+        page = self.page.replace('<td>66</td>', '<td><span>66</span></td>')
+        self.assertEqual(len(extract_standings_rows(page)), 50)
+
+
+ManagerRow = namedtuple('ManagerRow', ['id', 'name', 'club', 'team_name', 'country'])
+
+
+@unittest.skipIf(EPL_elite.pyarrow is None, "ParquetSaver needs pyarrow")
+class ParquetSaverTest(unittest.TestCase):
+    def test_small_commits_keep_every_row(self):
+        import pyarrow.dataset
+        with tempfile.TemporaryDirectory() as directory:
+            saver = EPL_elite.ParquetSaver(21, directory, close_on_commit=True)
+            for page in range(40):
+                for rank in range(50):
+                    manager_id = page * 50 + rank + 1
+                    saver.add_manager(ManagerRow(manager_id, "Manager", "Arsenal", "Team", "England"))
+                saver.commit()
+            saver.finish()
+            managers = pyarrow.dataset.dataset(os.path.join(directory, "Manager"), partitioning="hive")
+            self.assertEqual(managers.count_rows(), 2000)
+            self.assertEqual(len(managers.files), 40)
+
+
+SCHEMA = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sql files", "sqlite_db_build.sql")
+
+
+def create_database(filename):
+    connection = sqlite3.connect(filename)
+    with open(SCHEMA, 'r', encoding='UTF-8') as file:
+        connection.executescript(file.read())
+    connection.close()
+    return "sqlite:" + filename
+
+
+class DbSaverTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Exceptions.txt is written to the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        self.connection_string = create_database(os.path.join(directory.name, "epl.db"))
+
+    def create_saver(self, **options):
+        saver = EPL_elite.DbSaver(21, self.connection_string, statement_log=EPL_elite.StatementLog(sample_every=None),
+                                  **options)
+        self.addCleanup(saver.close)
+        return saver
+
+    def stored_manager_ids(self, saver):
+        return [manager_id for manager_id, in saver.connection.execute("SELECT managerID FROM Manager ORDER BY 1")]
+
+    def test_commit(self):
+        saver = self.create_saver()
+        for manager_id in (1, 2, 3):
+            saver.add_manager(ManagerRow(manager_id, "Manager", "Arsenal", "Team", "England"))
+        self.assertEqual(saver.commit(), 0)
+        self.assertEqual(self.stored_manager_ids(saver), [1, 2, 3])
+        self.assertEqual(saver.commit(), 0)
+
+    def test_rejected_row(self):
+        saver = self.create_saver()
+        for manager_id in (1, 2, 3):
+            saver.add_manager(ManagerRow(manager_id, None if manager_id == 2 else "Manager", "Arsenal", "Team",
+                                         "England"))
+        self.assertEqual(saver.commit(), 1)
+        self.assertEqual(self.stored_manager_ids(saver), [1, 3])
+
+    def test_batches_smaller_than_buffer(self):
+        saver = self.create_saver(batch_size=2)
+        batches = []
+        cursor = saver.cursor
+
+        class RecordingCursor(object):
+            def executemany(self, statement, rows):
+                batches.append(len(rows))
+                return cursor.executemany(statement, rows)
+        saver.cursor = RecordingCursor()
+        for manager_id in range(1, 6):
+            saver.add_manager(ManagerRow(manager_id, "Manager", "Arsenal", "Team", "England"))
+        self.assertEqual(saver.commit(), 0)
+        self.assertEqual(batches, [2, 2, 1])
+        self.assertEqual(self.stored_manager_ids(saver), [1, 2, 3, 4, 5])
+
+
+class ManagerCrawlTest(unittest.TestCase):
+    """Manager crawls of a synthetic league served by StubServer into sqlite."""
+    TABLES = ("Manager", "GameWeekTeam", "Position")
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = StubServer(league=SyntheticLeague(100))
+        cls.server.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.stop()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        # Execution_log.sql is written to the working directory
+        self.addCleanup(os.chdir, os.getcwd())
+        os.chdir(directory.name)
+        self.connection_string = create_database(os.path.join(directory.name, "epl.db"))
+        self.ledger_filename = os.path.join(directory.name, "ledger.db")
+
+    def crawl(self, finishing_rank, ledger=None):
+        controller = EPL_elite.FantasyEPLController(self.connection_string, base_url=self.server.url, game_week=21,
+                                                    ledger=ledger)
+        for handler in controller.storage_handlers:
+            self.addCleanup(handler.close)
+        controller.download_manager_stats(1, finishing_rank)
+        return controller
+
+    def row_counts(self):
+        connection = sqlite3.connect(self.connection_string[len("sqlite:"):])
+        try:
+            return [connection.execute("SELECT COUNT(*) FROM " + table).fetchone()[0] for table in self.TABLES]
+        finally:
+            connection.close()
+
+    def test_committing_a_page_twice(self):
+        self.crawl(50)
+        counts = self.row_counts()
+        self.assertEqual(counts, [50, 50, 750])
+        self.crawl(50)
+        self.assertEqual(self.row_counts(), counts)
+
+    def test_ledger_skips_committed_pages(self):
+        ledger = EPL_elite.JobLedger(self.ledger_filename)
+        self.addCleanup(ledger.connection.close)
+        self.assertEqual(self.crawl(50, ledger).managers_created, 50)
+        self.assertEqual(ledger.committed_pages(1415, 21, 313), {1})
+        self.assertEqual(self.crawl(100, ledger).managers_created, 50)
+        self.assertEqual(self.crawl(100, ledger).managers_created, 0)
+        self.assertEqual(self.row_counts(), [100, 100, 1500])
+
+
+class StartupTest(unittest.TestCase):
+    def test_import_stays_light(self):
+        check = "import sys, EPL_elite; print(','.join(module for module in {0!r} if module in sys.modules))".format(
+            EPL_bench.HEAVY_MODULES)
+        output = subprocess.run([sys.executable, "-c", check], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+        self.assertEqual(output.strip(), "")
+
+
+if __name__ == '__main__':
+    unittest.main()